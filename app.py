@@ -1,19 +1,35 @@
 import os
 import uuid
 import re
+import random
+import fcntl
+import functools
+import hashlib
+import importlib
+import io
 import json
 import math
+import mimetypes
+import multiprocessing
+import shutil
+import sqlite3
 import subprocess
 import sys
+import tempfile
 import threading
 import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from urllib.parse import quote
 
 from dotenv import load_dotenv
 load_dotenv()
 
-from flask import Flask, render_template, request, send_file, jsonify
-from PIL import Image, ImageDraw, ImageFont
+from flask import Flask, Response, render_template, request, send_file, jsonify, stream_with_context
+from PIL import Image, ImageDraw, ImageFont, ImageOps, ImageSequence, JpegImagePlugin
+from werkzeug.utils import safe_join
 
 DEFAULT_GEMINI_KEY = os.getenv('GEMINI_API_KEY', '')
 
@@ -38,56 +54,595 @@ TARGET_WIDTH_RATIO = 0.65
 # ═══════════════════════════════════════════════════════════════
 #  TASK MANAGEMENT (shared across tools)
 # ═══════════════════════════════════════════════════════════════
-TASKS = {}
-TASKS_LOCK = threading.Lock()
+# TASK_STORE_BACKEND=sqlite shares task state between gunicorn workers;
+# "memory" keeps it inside the current process (single worker / dev server).
+TASK_STORE_BACKEND = os.getenv('TASK_STORE_BACKEND', 'sqlite')
+DB_PATH = os.getenv('TOOLKIT_DB_PATH', os.path.join(BASE_DIR, 'toolkit.db'))
+TASK_TTL = int(os.getenv('TASK_TTL', 3600))
+TASK_CLEANUP_INTERVAL = 60
+TASK_STREAM_MAX_CLIENTS = int(os.getenv('TASK_STREAM_MAX_CLIENTS', 8))
+TASK_STREAM_MAX_AGE = 60  # seconds before a stream closes and the browser reconnects
+TASK_STREAM_POLL = 0.5  # fallback check for updates made by other workers
+
+_DB_LOCAL = threading.local()
+
+
+def get_db():
+    # One connection per thread (and per process, so forked workers never
+    # reuse the parent's handle).
+    conn = getattr(_DB_LOCAL, 'conn', None)
+    if conn is None or _DB_LOCAL.pid != os.getpid():
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _DB_LOCAL.conn = conn
+        _DB_LOCAL.pid = os.getpid()
+    return conn
+
+
+def close_db():
+    # For the gunicorn master before it forks: a SQLite handle must not be
+    # carried into a child process
+    conn = getattr(_DB_LOCAL, 'conn', None)
+    if conn is not None and _DB_LOCAL.pid == os.getpid():
+        conn.close()
+    _DB_LOCAL.conn = None
+
+
+class MemoryTaskStore:
+    def __init__(self):
+        # Ordered by last update, so expiry only touches the stale head.
+        self._tasks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set(self, task_id, info):
+        with self._lock:
+            previous = self._tasks.get(task_id)
+            info['version'] = previous['version'] + 1 if previous else 1
+            self._tasks[task_id] = info
+            self._tasks.move_to_end(task_id)
+
+    def get(self, task_id):
+        with self._lock:
+            return self._tasks.get(task_id)
+
+    def expire(self, cutoff):
+        with self._lock:
+            while self._tasks:
+                task_id, info = next(iter(self._tasks.items()))
+                if info['timestamp'] >= cutoff:
+                    break
+                del self._tasks[task_id]
+
+
+class SQLiteTaskStore:
+    def __init__(self):
+        get_db().executescript('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                version INTEGER NOT NULL DEFAULT 1
+            );
+            CREATE INDEX IF NOT EXISTS tasks_updated_at ON tasks (updated_at);
+        ''')
+        columns = [row[1] for row in get_db().execute('PRAGMA table_info(tasks)')]
+        if 'version' not in columns:
+            get_db().execute('ALTER TABLE tasks ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+
+    def set(self, task_id, info):
+        row = get_db().execute('''
+            INSERT INTO tasks (task_id, data, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT (task_id) DO UPDATE SET
+                data = excluded.data,
+                updated_at = excluded.updated_at,
+                version = tasks.version + 1
+            RETURNING version
+        ''', (task_id, json.dumps(info), info['timestamp'])).fetchone()
+        info['version'] = row[0]
+
+    def get(self, task_id):
+        row = get_db().execute(
+            'SELECT data, version FROM tasks WHERE task_id = ?', (task_id,)
+        ).fetchone()
+        if not row:
+            return None
+        info = json.loads(row[0])
+        info['version'] = row[1]
+        return info
+
+    def expire(self, cutoff):
+        get_db().execute('DELETE FROM tasks WHERE updated_at < ?', (cutoff,))
+
+
+TASK_STORES = {
+    'memory': MemoryTaskStore,
+    'sqlite': SQLiteTaskStore,
+}
+TASK_STORE = TASK_STORES[TASK_STORE_BACKEND]()
+TASK_CHANGED = threading.Condition()
+_last_cleanup = 0
+_stream_clients = 0
+
+
+def update_task_status(task_id, status, result=None, error=None, progress=None,
+                       queue_position=None, progress_detail=None):
+    TASK_STORE.set(task_id, {
+        'status': status,
+        'result': result,
+        'error': error,
+        'progress': progress,
+        'progress_detail': progress_detail,
+        'queue_position': queue_position,
+        'timestamp': time.time()
+    })
+    if status == 'completed' and result:
+        track_artifacts(task_id, result)
+    with TASK_CHANGED:
+        TASK_CHANGED.notify_all()
+
+
+def get_task(task_id):
+    return TASK_STORE.get(task_id)
+
+
+def wait_for_task_update(task_id, since, timeout):
+    # Updates from this process wake us immediately; updates written by
+    # another worker are picked up by re-reading the store every
+    # TASK_STREAM_POLL seconds.
+    deadline = time.time() + timeout
+    while True:
+        task_info = get_task(task_id)
+        remaining = deadline - time.time()
+        if task_info is None or task_info['version'] > since or remaining <= 0:
+            return task_info
+        with TASK_CHANGED:
+            TASK_CHANGED.wait(min(remaining, TASK_STREAM_POLL))
 
 
-def update_task_status(task_id, status, result=None, error=None, progress=None):
-    with TASKS_LOCK:
-        TASKS[task_id] = {
-            'status': status,
-            'result': result,
-            'error': error,
-            'progress': progress,
-            'timestamp': time.time()
-        }
+def cleanup_old_tasks():
+    # Called from request handlers; the store expiry is indexed, and it (plus
+    # the sweep of abandoned chunked uploads) only runs once per
+    # TASK_CLEANUP_INTERVAL.
+    global _last_cleanup
+    start_metrics_flusher()
+    current_time = time.time()
+    if current_time - _last_cleanup < TASK_CLEANUP_INTERVAL:
+        return
+    _last_cleanup = current_time
+    TASK_STORE.expire(current_time - TASK_TTL)
+    cleanup_stale_uploads()
 
 
-def cleanup_old_tasks():
-    with TASKS_LOCK:
-        current_time = time.time()
-        to_remove = [tid for tid, info in TASKS.items()
-                     if current_time - info.get('timestamp', 0) > 3600]
-        for tid in to_remove:
-            del TASKS[tid]
+# ═══════════════════════════════════════════════════════════════
+#  JOB SCHEDULER (bounded concurrency per tool)
+# ═══════════════════════════════════════════════════════════════
+# limit: jobs running at once per worker process
+# max_queue: jobs allowed to wait before new requests get HTTP 429
+# retry_after: seconds suggested to the client when the queue is full
+JOB_POOLS = {
+    'ffmpeg': {
+        'limit': int(os.getenv('FFMPEG_JOB_LIMIT', 1)),
+        'max_queue': int(os.getenv('FFMPEG_QUEUE_SIZE', 10)),
+        'retry_after': 30,
+    },
+    'image': {
+        'limit': int(os.getenv('IMAGE_JOB_LIMIT', 2)),
+        'max_queue': int(os.getenv('IMAGE_QUEUE_SIZE', 50)),
+        'retry_after': 5,
+    },
+    'gemini': {
+        'limit': int(os.getenv('GEMINI_JOB_LIMIT', 4)),
+        'max_queue': int(os.getenv('GEMINI_QUEUE_SIZE', 20)),
+        'retry_after': 15,
+    },
+}
+JOB_QUEUES = {pool: deque() for pool in JOB_POOLS}
+JOB_RUNNING = {pool: 0 for pool in JOB_POOLS}
+JOBS_LOCK = threading.Lock()
+
+
+def job_queue_full(pool):
+    with JOBS_LOCK:
+        return (JOB_RUNNING[pool] >= JOB_POOLS[pool]['limit']
+                and len(JOB_QUEUES[pool]) >= JOB_POOLS[pool]['max_queue'])
+
+
+def submit_job(pool, task_id, target, *args):
+    # Returns False when the pool's queue is full (caller answers with 429).
+    # A job that gets a free slot goes straight to its worker, so the queue
+    # only ever holds jobs that are really waiting.
+    with JOBS_LOCK:
+        job = (task_id, target, args, time.time())
+        if JOB_RUNNING[pool] < JOB_POOLS[pool]['limit']:
+            JOB_RUNNING[pool] += 1
+            update_task_status(task_id, 'queued')
+            threading.Thread(target=_job_worker, args=(pool, job), daemon=True).start()
+            return True
+
+        queue = JOB_QUEUES[pool]
+        if len(queue) >= JOB_POOLS[pool]['max_queue']:
+            return False
+        update_task_status(task_id, 'queued')
+        queue.append(job)
+        _report_queue_positions(pool)
+    return True
+
+
+def _report_queue_positions(pool):
+    # Caller holds JOBS_LOCK. Queues are bounded, so this stays cheap.
+    for position, (task_id, *_) in enumerate(JOB_QUEUES[pool], start=1):
+        update_task_status(task_id, 'queued',
+                           progress=f'Waiting in queue (position {position})...',
+                           queue_position=position)
+
+
+def _job_worker(pool, job):
+    # Runs the job it was started for, then drains the queue
+    released = False
+    try:
+        while True:
+            _run_job(*job)
+            with JOBS_LOCK:
+                queue = JOB_QUEUES[pool]
+                if not queue:
+                    JOB_RUNNING[pool] -= 1
+                    released = True
+                    return
+                job = queue.popleft()
+                try:
+                    _report_queue_positions(pool)
+                except Exception as e:
+                    print(f"Could not report queue positions: {e}")
+    finally:
+        # Give the slot back however the loop ended, or the pool shrinks for good
+        if not released:
+            with JOBS_LOCK:
+                JOB_RUNNING[pool] -= 1
+
+
+def _run_job(task_id, target, args, queued_at):
+    # Only target may fail; the bookkeeping around it must not stop the worker
+    started = time.time()
+    try:
+        target(task_id, *args)
+    except Exception as e:
+        try:
+            update_task_status(task_id, 'failed', error=str(e))
+        except Exception as e:
+            print(f"Could not mark task {task_id} failed: {e}")
+    finished = time.time()
+    try:
+        tool = job_tool_name(target)
+        status = (get_task(task_id) or {}).get('status', 'unknown')
+        observe('job_queue_seconds', started - queued_at, tool=tool)
+        observe('job_run_seconds', finished - started, tool=tool, status=status)
+        observe('job_total_seconds', finished - queued_at, tool=tool, status=status)
+    except Exception as e:
+        print(f"Could not record job metrics: {e}")
+
+
+def job_tool_name(target):
+    # process_contact_sheet_task -> contact_sheet
+    name = target.__name__
+    if name.startswith('process_'):
+        name = name[len('process_'):]
+    if name.endswith('_task'):
+        name = name[:-len('_task')]
+    return name
+
+
+def queue_full_response(pool):
+    retry_after = JOB_POOLS[pool]['retry_after']
+    response = jsonify({
+        'error': f'Server is busy. Please retry in {retry_after} seconds.',
+        'retry_after': retry_after
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+# ═══════════════════════════════════════════════════════════════
+#  FFMPEG RUNNER (streamed progress, bounded stderr, stall watchdog)
+# ═══════════════════════════════════════════════════════════════
+FFMPEG_STALL_TIMEOUT = int(os.getenv('FFMPEG_STALL_TIMEOUT', 120))
+FFMPEG_STDERR_LINES = 50
+FFMPEG_REPORT_INTERVAL = 1.0
+SHOWINFO_PTS_RE = re.compile(r'pts_time:([\d.]+)')
+
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds}s"
+
+
+def ffmpeg_progress_reporter(task_id, label, partial_result=None):
+    # partial_result is a dict the task keeps filling in (e.g. finished
+    # pages); it is republished with every progress update.
+    def report(percent, fps, eta):
+        text = label
+        if percent is not None:
+            text = f"{label} {percent:.0f}%"
+            if eta is not None:
+                text += f" (ETA {format_eta(eta)})"
+        update_task_status(task_id, 'processing', progress=text, result=partial_result, progress_detail={
+            'percent': percent,
+            'fps': fps,
+            'eta': eta
+        })
+    return report
+
+
+def run_ffmpeg(cmd, duration=None, on_progress=None):
+    # Runs ffmpeg with `-progress pipe:1` and parses it line by line.
+    # Filters that only emit output at the end (tile) get their position
+    # from `showinfo` lines on stderr instead. Only the last
+    # FFMPEG_STDERR_LINES lines of stderr are kept for error messages.
+    with timed('ffmpeg'):
+        return _run_ffmpeg(cmd, duration, on_progress)
+
+
+def _run_ffmpeg(cmd, duration, on_progress):
+    cmd = [cmd[0], '-nostats', '-progress', 'pipe:1'] + cmd[1:]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            text=True, errors='replace')
+
+    stderr_tail = deque(maxlen=FFMPEG_STDERR_LINES)
+    started = time.time()
+    state = {'position': 0.0, 'fps': None, 'last_activity': started,
+             'last_report': 0.0, 'stalled': False, 'error': None}
+    state_lock = threading.Lock()
+
+    def advance(position=None):
+        with state_lock:
+            state['last_activity'] = time.time()
+            if position is not None and position > state['position']:
+                state['position'] = position
+            if on_progress is None or state['last_activity'] - state['last_report'] < FFMPEG_REPORT_INTERVAL:
+                return
+            state['last_report'] = state['last_activity']
+            position = state['position']
+            fps = state['fps']
+
+        percent = eta = None
+        if duration and position > 0:
+            percent = min(position / duration * 100, 99.9)
+            elapsed = time.time() - started
+            eta = max(elapsed * (duration - position) / position, 0)
+        on_progress(percent, fps, eta)
+
+    def read_stderr():
+        # Keeps draining after a failed callback so ffmpeg never blocks on
+        # a full pipe; the main loop raises the error
+        for line in proc.stderr:
+            stderr_tail.append(line.rstrip())
+            match = SHOWINFO_PTS_RE.search(line)
+            try:
+                advance(float(match.group(1)) if match else None)
+            except Exception as e:
+                state['error'] = state['error'] or e
+
+    def watchdog():
+        while proc.poll() is None:
+            time.sleep(1)
+            if time.time() - state['last_activity'] > FFMPEG_STALL_TIMEOUT:
+                state['stalled'] = True
+                proc.kill()
+                return
+
+    stderr_thread = threading.Thread(target=read_stderr, daemon=True)
+    stderr_thread.start()
+    threading.Thread(target=watchdog, daemon=True).start()
+
+    # A failing on_progress (or anything else) must not leave ffmpeg
+    # running unattended: kill it, then always reap it
+    position = None
+    try:
+        for line in proc.stdout:
+            key, _, value = line.strip().partition('=')
+            if key == 'out_time_us' and value.isdigit():
+                position = int(value) / 1_000_000
+            elif key == 'fps':
+                try:
+                    state['fps'] = float(value)
+                except ValueError:
+                    pass
+            elif key == 'progress':
+                advance(position)
+            if state['error']:
+                raise state['error']
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.wait()
+        stderr_thread.join()
+
+    if state['error']:
+        raise state['error']
+
+    if state['stalled']:
+        raise RuntimeError(f"ffmpeg stalled (no progress for {FFMPEG_STALL_TIMEOUT}s)")
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr='\n'.join(stderr_tail))
+
+
+# ═══════════════════════════════════════════════════════════════
+#  MEDIA PROBE (one ffprobe per file, shared by all tools)
+# ═══════════════════════════════════════════════════════════════
+PROBE_CACHE_SIZE = 64
+
+_PROBE_CACHE = OrderedDict()
+_PROBE_CACHE_LOCK = threading.Lock()
+
+
+def parse_frame_rate(value):
+    num, _, den = (value or '').partition('/')
+    try:
+        rate = float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+    return round(rate, 3) if rate > 0 else None
+
+
+def stream_rotation(stream):
+    # Newer ffprobe reports a display matrix, older builds a rotate tag
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            return int(side_data['rotation']) % 360
+    try:
+        return int(stream.get('tags', {}).get('rotate', 0)) % 360
+    except ValueError:
+        return 0
+
+
+def probe_video(video_path):
+    stat = os.stat(video_path)
+    key = (os.path.realpath(video_path), stat.st_mtime_ns, stat.st_size)
+    with _PROBE_CACHE_LOCK:
+        if key in _PROBE_CACHE:
+            _PROBE_CACHE.move_to_end(key)
+            return _PROBE_CACHE[key]
+
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-print_format", "json",
+        "-show_format",
+        "-show_streams",
+        video_path
+    ]
+    try:
+        with timed('ffprobe'):
+            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        data = json.loads(result.stdout)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        raise ValueError(f"Could not read video metadata: {getattr(e, 'stderr', None) or e}")
+
+    streams = data.get('streams', [])
+    video_stream = next((st for st in streams if st.get('codec_type') == 'video'), None)
+    audio_stream = next((st for st in streams if st.get('codec_type') == 'audio'), None)
+    if video_stream is None or not video_stream.get('width'):
+        raise ValueError("No video stream found")
+
+    duration = data.get('format', {}).get('duration') or video_stream.get('duration')
+    rotation = stream_rotation(video_stream)
+    coded_width, coded_height = video_stream['width'], video_stream['height']
+    # ffmpeg applies the rotation when decoding, so filters see display size
+    if rotation in (90, 270):
+        width, height = coded_height, coded_width
+    else:
+        width, height = coded_width, coded_height
+
+    info = {
+        'duration': float(duration) if duration else None,
+        'width': width,
+        'height': height,
+        'coded_width': coded_width,
+        'coded_height': coded_height,
+        'rotation': rotation,
+        'video_codec': video_stream.get('codec_name'),
+        'fps': parse_frame_rate(video_stream.get('avg_frame_rate'))
+               or parse_frame_rate(video_stream.get('r_frame_rate')),
+        'audio_codec': audio_stream.get('codec_name') if audio_stream else None,
+        'has_audio': audio_stream is not None,
+    }
+
+    with _PROBE_CACHE_LOCK:
+        _PROBE_CACHE[key] = info
+        while len(_PROBE_CACHE) > PROBE_CACHE_SIZE:
+            _PROBE_CACHE.popitem(last=False)
+    return info
 
 
 # ═══════════════════════════════════════════════════════════════
 #  WATERMARK FUNCTIONS
 # ═══════════════════════════════════════════════════════════════
-IMAGE_EXTS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
+IMAGE_EXTS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp', '.gif'}
+EXIF_ORIENTATION = 0x0112
 VIDEO_EXTS = {'.mp4', '.mov', '.avi', '.mkv', '.webm'}
 
-
-def get_optimal_font_size(img_width):
+# Per output container: audio codecs that can be stream-copied (None = any),
+# the audio encoder used otherwise, and muxer flags.
+CONTAINER_CODECS = {
+    '.mp4': {'video': 'libx264', 'copy_audio': {'aac', 'mp3', 'ac3', 'eac3', 'alac', 'opus', 'flac'},
+             'audio': ['-c:a', 'aac'], 'muxer': ['-movflags', '+faststart']},
+    '.mov': {'video': 'libx264', 'copy_audio': {'aac', 'mp3', 'ac3', 'alac', 'pcm_s16le', 'pcm_s24le'},
+             'audio': ['-c:a', 'aac'], 'muxer': ['-movflags', '+faststart']},
+    '.mkv': {'video': 'libx264', 'copy_audio': None, 'audio': ['-c:a', 'aac'], 'muxer': []},
+    '.avi': {'video': 'libx264', 'copy_audio': {'mp3', 'ac3', 'pcm_s16le'},
+             'audio': ['-c:a', 'libmp3lame'], 'muxer': []},
+    '.webm': {'video': 'libvpx-vp9', 'copy_audio': {'opus', 'vorbis'},
+              'audio': ['-c:a', 'libopus'], 'muxer': []},
+}
+
+# Software encoder profiles; VIDEO_ENCODER_PROFILE picks the default and
+# uploads can choose another with the `profile` form field.
+VIDEO_ENCODER_PROFILES = {
+    'fast': {'preset': 'ultrafast', 'crf': 23, 'tune': None},
+    'balanced': {'preset': 'veryfast', 'crf': 21, 'tune': None},
+    'quality': {'preset': 'medium', 'crf': 19, 'tune': 'film'},
+}
+VIDEO_ENCODER_PROFILE = os.getenv('VIDEO_ENCODER_PROFILE', 'fast')
+VIDEO_ENCODER_THREADS = int(os.getenv('VIDEO_ENCODER_THREADS', 0))  # 0 = let ffmpeg decide
+VIDEO_PREVIEW = os.getenv('VIDEO_PREVIEW', '0') == '1'
+VIDEO_PREVIEW_HEIGHT = 720
+
+
+# Fonts, glyph widths and finished overlays are reused across jobs. Overlay
+# PNGs for ffmpeg are kept in WATERMARK_CACHE_DIR when it is set (persisted
+# and shared between workers), otherwise in a per-process temp directory.
+WATERMARK_CACHE_SIZE = int(os.getenv('WATERMARK_CACHE_SIZE', 16))
+WATERMARK_CACHE_MAX_BYTES = int(os.getenv('WATERMARK_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+WATERMARK_CACHE_DIR = os.getenv('WATERMARK_CACHE_DIR')
+
+_OVERLAY_CACHE = OrderedDict()
+_OVERLAY_CACHE_LOCK = threading.Lock()
+
+
+def get_watermark_cache_dir():
+    # Created on first use so batch pool workers don't each leave an empty
+    # temp directory behind.
+    global WATERMARK_CACHE_DIR
+    if not WATERMARK_CACHE_DIR:
+        WATERMARK_CACHE_DIR = tempfile.mkdtemp(prefix='otsu_wm_')
+    os.makedirs(WATERMARK_CACHE_DIR, exist_ok=True)
+    return WATERMARK_CACHE_DIR
+
+
+@functools.lru_cache(maxsize=32)
+def load_font(size):
+    return ImageFont.truetype(FONT_PATH, size)
+
+
+@functools.lru_cache(maxsize=64)
+def get_glyph_widths(text, size):
+    font = load_font(size)
+    widths = []
+    for char in text:
+        bbox = font.getbbox(char)
+        widths.append(bbox[2] - bbox[0])
+    return tuple(widths)
+
+
+def get_text_width(widths, size):
+    spacing = size * LETTER_SPACING
+    return sum(widths) + spacing * (len(widths) - 1)
+
+
+def get_optimal_font_size(img_width, text=WATERMARK_TEXT):
     ref_size = 100
     try:
-        font = ImageFont.truetype(FONT_PATH, ref_size)
+        widths = get_glyph_widths(text, ref_size)
     except OSError:
-        font = ImageFont.load_default()
         return int(img_width * 0.1)
 
-    dummy_img = Image.new('RGBA', (1, 1))
-    draw = ImageDraw.Draw(dummy_img)
-
-    total_width = 0
-    spacing = ref_size * LETTER_SPACING
-    for char in WATERMARK_TEXT:
-        bbox = draw.textbbox((0, 0), char, font=font)
-        char_w = bbox[2] - bbox[0]
-        total_width += char_w + spacing
-    total_width -= spacing
-
+    total_width = get_text_width(widths, ref_size)
     if total_width <= 0:
         return ref_size
 
@@ -96,116 +651,256 @@ def get_optimal_font_size(img_width):
     return int(ref_size * scale_factor)
 
 
-def add_watermark_to_image(input_path, output_path):
-    with Image.open(input_path) as img:
-        img = img.convert("RGBA")
-        txt_layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(txt_layer)
-
-        font_size = get_optimal_font_size(img.width)
-        font = ImageFont.truetype(FONT_PATH, font_size)
-
-        total_width = 0
-        spacing = font_size * LETTER_SPACING
-        chars_info = []
-        for char in WATERMARK_TEXT:
-            bbox = draw.textbbox((0, 0), char, font=font)
-            char_w = bbox[2] - bbox[0]
-            chars_info.append((char, char_w))
-            total_width += char_w + spacing
-        total_width -= spacing
-
-        start_x = (img.width - total_width) / 2
-        center_y = img.height / 2
-
-        current_x = start_x
-        for char, char_w in chars_info:
-            draw.text((current_x, center_y), char, font=font,
-                      fill=(255, 255, 255, OPACITY), anchor="lm")
-            current_x += char_w + spacing
-
-        out = Image.alpha_composite(img, txt_layer)
-        if output_path.lower().endswith(('.jpg', '.jpeg')):
-            out = out.convert("RGB")
-        out.save(output_path)
-
-
-def add_watermark_to_video(input_path, output_path):
-    cmd_probe = [
-        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
-        '-show_entries', 'stream=width,height', '-of', 'csv=s=x:p=0', input_path
-    ]
-    try:
-        dim = subprocess.check_output(cmd_probe).decode('utf-8').strip().split('x')
-        width, height = int(dim[0]), int(dim[1])
-    except Exception:
-        width, height = 1920, 1080
-
-    txt_img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(txt_img)
-
-    font_size = get_optimal_font_size(width)
-    font = ImageFont.truetype(FONT_PATH, font_size)
-
-    total_width = 0
+def render_watermark_overlay(width, height, text, opacity):
+    # Renders only the text's bounding box. Returns the RGBA patch and the
+    # (x, y) where it goes on a width x height frame.
+    font_size = get_optimal_font_size(width, text)
+    font = load_font(font_size)
+    widths = get_glyph_widths(text, font_size)
     spacing = font_size * LETTER_SPACING
-    chars_info = []
-    for char in WATERMARK_TEXT:
-        char_bbox = draw.textbbox((0, 0), char, font=font)
-        char_w = char_bbox[2] - char_bbox[0]
-        chars_info.append((char, char_w))
-        total_width += char_w + spacing
-    total_width -= spacing
-
-    start_x = (width - total_width) / 2
+
+    positions = []
+    current_x = (width - get_text_width(widths, font_size)) / 2
     center_y = height / 2
+    for char, char_w in zip(text, widths):
+        positions.append((char, current_x))
+        current_x += char_w + spacing
+
+    boxes = []
+    for char, x in positions:
+        bbox = font.getbbox(char, anchor="lm")
+        boxes.append((x + bbox[0], center_y + bbox[1], x + bbox[2], center_y + bbox[3]))
+    left = max(0, math.floor(min(b[0] for b in boxes)))
+    top = max(0, math.floor(min(b[1] for b in boxes)))
+    right = min(width, math.ceil(max(b[2] for b in boxes)) + 1)
+    bottom = min(height, math.ceil(max(b[3] for b in boxes)) + 1)
+
+    # Integer offsets keep the fractional glyph positions, so the patch is
+    # pixel-identical to drawing on a full-frame layer.
+    patch = Image.new("RGBA", (max(right - left, 1), max(bottom - top, 1)), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(patch)
+    for char, x in positions:
+        draw.text((x - left, center_y - top), char, font=font,
+                  fill=(255, 255, 255, opacity), anchor="lm")
+
+    return patch, (left, top)
+
+
+def get_watermark_overlay(width, height, text=WATERMARK_TEXT, opacity=OPACITY):
+    key = (width, height, text, opacity)
+    with _OVERLAY_CACHE_LOCK:
+        if key in _OVERLAY_CACHE:
+            _OVERLAY_CACHE.move_to_end(key)
+            return _OVERLAY_CACHE[key]
+
+    overlay = render_watermark_overlay(width, height, text, opacity)
+    patch_bytes = overlay[0].width * overlay[0].height * 4
+
+    if patch_bytes <= WATERMARK_CACHE_MAX_BYTES:
+        with _OVERLAY_CACHE_LOCK:
+            _OVERLAY_CACHE[key] = overlay
+            cached_bytes = sum(p.width * p.height * 4 for p, _ in _OVERLAY_CACHE.values())
+            while len(_OVERLAY_CACHE) > WATERMARK_CACHE_SIZE or cached_bytes > WATERMARK_CACHE_MAX_BYTES:
+                _, (patch, _) = _OVERLAY_CACHE.popitem(last=False)
+                cached_bytes -= patch.width * patch.height * 4
+    return overlay
+
+
+def get_watermark_overlay_file(width, height, text=WATERMARK_TEXT, opacity=OPACITY):
+    # The file name covers every setting that changes the rendering, so a
+    # persisted directory stays valid across deploys and workers.
+    patch, position = get_watermark_overlay(width, height, text, opacity)
+    digest = hashlib.sha1(
+        repr((text, opacity, FONT_PATH, LETTER_SPACING, TARGET_WIDTH_RATIO)).encode('utf-8')
+    ).hexdigest()[:12]
+    path = os.path.join(get_watermark_cache_dir(), f"wm_{width}x{height}_{digest}.png")
+    if not os.path.exists(path):
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        patch.save(temp_path, format='PNG')
+        os.replace(temp_path, path)
+    return path, position
+
+
+def apply_watermark(img):
+    # Blends the cached patch into its region only; the rest of the image
+    # is never copied. Returns the (possibly converted) image.
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA")
 
-    for char, char_w in chars_info:
-        draw.text((start_x, center_y), char, font=font,
-                  fill=(255, 255, 255, OPACITY), anchor="lm")
-        start_x += char_w + spacing
+    patch, (x, y) = get_watermark_overlay(img.width, img.height)
+    if img.mode == "RGBA":
+        img.alpha_composite(patch, dest=(x, y))
+    else:
+        box = (x, y, x + patch.width, y + patch.height)
+        region = img.crop(box).convert("RGBA")
+        region.alpha_composite(patch)
+        img.paste(region.convert(img.mode), box)
+    return img
+
+
+def image_save_options(source, output_path):
+    # Keeps EXIF and (for RGB sources) the colour profile. JPEG to JPEG
+    # re-encodes with the source's own quantization tables and chroma
+    # subsampling instead of Pillow's defaults, so quality and file size
+    # stay close to the original.
+    options = {}
+    if source.info.get('exif'):
+        options['exif'] = source.info['exif']
+    if source.info.get('icc_profile') and source.mode in ('RGB', 'RGBA', 'P'):
+        options['icc_profile'] = source.info['icc_profile']
+    if (source.format == 'JPEG' and source.mode == 'RGB'
+            and output_path.lower().endswith(('.jpg', '.jpeg'))):
+        options['qtables'] = source.quantization
+        subsampling = JpegImagePlugin.get_sampling(source)
+        if subsampling != -1:
+            options['subsampling'] = subsampling
+    return options
 
-    temp_wm_path = os.path.join(OUTPUT_FOLDER, f"temp_wm_{uuid.uuid4().hex}.png")
-    txt_img.save(temp_wm_path)
 
-    try:
-        cmd_ffmpeg = [
-            'ffmpeg', '-y',
-            '-i', input_path,
-            '-i', temp_wm_path,
-            '-filter_complex', 'overlay=0:0',
-            '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23',
-            '-c:a', 'copy',
-            '-movflags', '+faststart',
-            output_path
-        ]
-        subprocess.run(cmd_ffmpeg, check=True, capture_output=True)
-    except subprocess.CalledProcessError:
-        cmd_ffmpeg = [
-            'ffmpeg', '-y',
-            '-i', input_path,
-            '-i', temp_wm_path,
-            '-filter_complex', 'overlay=0:0',
-            '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23',
-            '-c:a', 'aac',
+def add_watermark_to_image(input_path, output_path):
+    with Image.open(input_path) as img:
+        output_format = Image.registered_extensions().get(os.path.splitext(output_path)[1].lower())
+        if getattr(img, 'n_frames', 1) > 1 and output_format in Image.SAVE_ALL:
+            add_watermark_to_frames(img, output_path, output_format)
+            return
+
+        img.load()
+        options = image_save_options(img, output_path)
+        if img.getexif().get(EXIF_ORIENTATION, 1) != 1:
+            # Upright pixels so the watermark is centred on the image as
+            # displayed; the kept EXIF loses its orientation tag
+            img = ImageOps.exif_transpose(img)
+            if 'exif' in options:
+                options['exif'] = img.info['exif']
+        out = apply_watermark(img)
+        if output_path.lower().endswith(('.jpg', '.jpeg')) and out.mode != "RGB":
+            out = out.convert("RGB")
+        out.save(output_path, **options)
+
+
+def add_watermark_to_frames(img, output_path, output_format):
+    # Animated GIF/WebP/PNG and multi-page TIFF: frames are decoded and
+    # watermarked one at a time against the shared overlay cache. The GIF
+    # and TIFF writers take append_images as an iterator and each frame's
+    # own duration, so they get a generator; WebP and PNG need every
+    # frame's duration up front and get a list.
+    options = image_save_options(img, output_path)
+    loop = img.info.get('loop')
+    frames = watermarked_frames(img)
+    first = next(frames)
+    if output_format in ('GIF', 'TIFF'):
+        options.update(save_all=True, append_images=frames)
+    else:
+        rest = list(frames)
+        durations = [frame.info['duration'] for frame in [first] + rest]
+        options.update(save_all=True, append_images=rest)
+        if any(durations):
+            options['duration'] = durations
+    if loop is not None:
+        options['loop'] = loop
+    first.save(output_path, **options)
+
+
+def watermarked_frames(img):
+    # Palette frames without transparency go back to an adaptive palette
+    # after the watermark, a third of the memory of an RGB copy
+    for frame in ImageSequence.Iterator(img):
+        # WebP sets a frame's duration only once it is decoded
+        frame.load()
+        has_alpha = frame.mode in ('RGBA', 'LA', 'PA') or 'transparency' in frame.info
+        duration = frame.info.get('duration', 0)
+        out = apply_watermark(frame.convert('RGBA' if has_alpha else 'RGB'))
+        if frame.mode == 'P' and not has_alpha:
+            out = out.convert('P', palette=Image.Palette.ADAPTIVE)
+        out.info['duration'] = duration
+        yield out
+
+
+def video_encoder_args(ext, profile_name=None):
+    profile = VIDEO_ENCODER_PROFILES[profile_name or VIDEO_ENCODER_PROFILE]
+    if CONTAINER_CODECS[ext]['video'] == 'libvpx-vp9':
+        # VP9 crf runs on a 0-63 scale; realtime keeps it close to x264 speed
+        args = ['-c:v', 'libvpx-vp9', '-deadline', 'realtime', '-cpu-used', '8',
+                '-crf', str(profile['crf'] + 10), '-b:v', '0']
+    else:
+        args = ['-c:v', 'libx264', '-preset', profile['preset'], '-crf', str(profile['crf'])]
+        if profile['tune']:
+            args += ['-tune', profile['tune']]
+    if VIDEO_ENCODER_THREADS:
+        args += ['-threads', str(VIDEO_ENCODER_THREADS)]
+    return args
+
+
+def audio_output_args(ext, audio_codec):
+    if audio_codec is None:
+        return []
+    copyable = CONTAINER_CODECS[ext]['copy_audio']
+    if copyable is None or audio_codec in copyable:
+        return ['-c:a', 'copy']
+    return CONTAINER_CODECS[ext]['audio']
+
+
+def add_watermark_to_video(input_path, output_path, on_progress=None, profile=None,
+                           preview_path=None):
+    # The probe gives the displayed (rotation-applied) frame size and the
+    # audio codec, so stream copy vs. re-encode is decided before the
+    # (single) encode starts.
+    info = probe_video(input_path)
+    width, height = info['width'], info['height']
+    audio_codec = info['audio_codec']
+    duration = info['duration']
+
+    wm_path, (wm_x, wm_y) = get_watermark_overlay_file(width, height)
+
+    ext = os.path.splitext(output_path)[1].lower()
+    make_preview = preview_path is not None and height > VIDEO_PREVIEW_HEIGHT
+
+    filter_graph = f'[0:v][1:v]overlay={wm_x}:{wm_y}'
+    if make_preview:
+        # Both outputs share one decode + overlay pass
+        filter_graph += f',split=2[full][small];[small]scale=-2:{VIDEO_PREVIEW_HEIGHT}[preview]'
+    else:
+        filter_graph += '[full]'
+
+    cmd_ffmpeg = [
+        'ffmpeg', '-y',
+        '-i', input_path,
+        '-i', wm_path,
+        '-filter_complex', filter_graph,
+        '-map', '[full]', '-map', '0:a:0?',
+        *video_encoder_args(ext, profile),
+        *audio_output_args(ext, audio_codec),
+        *CONTAINER_CODECS[ext]['muxer'],
+        output_path
+    ]
+    if make_preview:
+        cmd_ffmpeg += [
+            '-map', '[preview]', '-map', '0:a:0?',
+            *video_encoder_args('.mp4', 'fast'),
+            *audio_output_args('.mp4', audio_codec),
             '-movflags', '+faststart',
-            output_path
+            preview_path
         ]
-        subprocess.run(cmd_ffmpeg, check=True, capture_output=True)
-    finally:
-        if os.path.exists(temp_wm_path):
-            os.remove(temp_wm_path)
+
+    run_ffmpeg(cmd_ffmpeg, duration, on_progress)
+    return make_preview
 
 
-def process_watermark_task(task_id, input_path, output_path, ext, original_filename):
+def process_watermark_task(task_id, input_path, output_path, ext, original_filename,
+                           profile=None, preview=False, cache_key=None):
     try:
         update_task_status(task_id, 'processing', progress='Adding watermark...')
 
+        preview_filename = None
         if ext in IMAGE_EXTS:
             add_watermark_to_image(input_path, output_path)
             file_type = 'image'
         elif ext in VIDEO_EXTS:
-            add_watermark_to_video(input_path, output_path)
+            preview_path = os.path.join(OUTPUT_FOLDER, f"preview_{task_id}.mp4") if preview else None
+            if add_watermark_to_video(input_path, output_path,
+                                      ffmpeg_progress_reporter(task_id, 'Adding watermark...'),
+                                      profile, preview_path):
+                preview_filename = os.path.basename(preview_path)
             file_type = 'video'
         else:
             raise ValueError(f"Unsupported format: {ext}")
@@ -213,20 +908,329 @@ def process_watermark_task(task_id, input_path, output_path, ext, original_filen
         if os.path.exists(input_path):
             os.remove(input_path)
 
-        update_task_status(task_id, 'completed', result={
+        result = {
             'filename': os.path.basename(output_path),
+            'preview_filename': preview_filename,
             'original_name': original_filename,
             'type': file_type
-        })
+        }
+        if cache_key:
+            result_cache_put(cache_key, 'watermark', result)
+        update_task_status(task_id, 'completed', result=result)
     except Exception as e:
         update_task_status(task_id, 'failed', error=str(e))
         if os.path.exists(input_path):
             os.remove(input_path)
 
 
+def parse_watermark_options(ext, params):
+    if ext not in IMAGE_EXTS and ext not in VIDEO_EXTS:
+        raise ValueError(f'Unsupported file format: {ext}')
+
+    profile = params.get('profile') or VIDEO_ENCODER_PROFILE
+    if profile not in VIDEO_ENCODER_PROFILES:
+        raise ValueError(f'Unknown encoder profile: {profile}')
+
+    return {
+        'pool': 'image' if ext in IMAGE_EXTS else 'ffmpeg',
+        'profile': profile,
+        'preview': str(params.get('preview', '1' if VIDEO_PREVIEW else '0')) == '1'
+    }
+
+
+def submit_watermark_job(task_id, input_path, ext, original_filename, options):
+    output_filename = f"watermarked_{task_id}{ext}"
+    output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+    return submit_job(options['pool'], task_id, process_watermark_task,
+                      input_path, output_path, ext, original_filename,
+                      options['profile'], options['preview'], options.get('cache_key'))
+
+
+# ═══════════════════════════════════════════════════════════════
+#  BATCH WATERMARK (process pool for images)
+# ═══════════════════════════════════════════════════════════════
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', 1000))
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+IMAGE_PROCESS_WORKERS = int(os.getenv('IMAGE_PROCESS_WORKERS', 0)) or os.cpu_count() or 1
+
+_image_process_pool = None
+_image_process_pool_lock = threading.Lock()
+
+
+def get_image_process_pool():
+    # Pillow compositing holds the GIL, so batches fan out to processes.
+    # "spawn" avoids forking a gunicorn worker that has other threads running.
+    global _image_process_pool
+    with _image_process_pool_lock:
+        if _image_process_pool is None:
+            _image_process_pool = ProcessPoolExecutor(
+                max_workers=IMAGE_PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _image_process_pool
+
+
+def unique_archive_name(name, used):
+    base, ext = os.path.splitext(name)
+    candidate = name
+    counter = 1
+    while candidate.lower() in used:
+        candidate = f"{base}_{counter}{ext}"
+        counter += 1
+    used.add(candidate.lower())
+    return candidate
+
+
+def extract_batch_zip(zip_path, batch_dir, start_index=0):
+    # Keeps image members only, flattened to their base names, and refuses
+    # archives that expand beyond BATCH_MAX_BYTES.
+    items = []
+    total_bytes = 0
+    with zipfile.ZipFile(zip_path) as archive:
+        for member in archive.infolist():
+            name = os.path.basename(member.filename)
+            ext = os.path.splitext(name)[1].lower()
+            if member.is_dir() or not name or name.startswith('.') or ext not in IMAGE_EXTS:
+                continue
+            total_bytes += member.file_size
+            if total_bytes > BATCH_MAX_BYTES or start_index + len(items) >= BATCH_MAX_FILES:
+                raise ValueError('Archive is too large for one batch')
+            input_path = os.path.join(batch_dir, f"{start_index + len(items):05d}{ext}")
+            with archive.open(member) as src, open(input_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            items.append((input_path, name))
+    return items
+
+
+def process_watermark_batch_task(task_id, batch_dir, items):
+    try:
+        total = len(items)
+        update_task_status(task_id, 'processing', progress=f'Watermarking 0/{total}...',
+                           progress_detail={'percent': 0, 'done': 0, 'total': total})
+
+        output_filename = f"watermarked_batch_{task_id}.zip"
+        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+        pool = get_image_process_pool()
+
+        futures = {}
+        for index, (input_path, original_name) in enumerate(items):
+            ext = os.path.splitext(input_path)[1]
+            item_output = os.path.join(batch_dir, f"out_{index:05d}{ext}")
+            future = pool.submit(add_watermark_to_image, input_path, item_output)
+            futures[future] = (index, item_output, original_name)
+
+        results = [None] * total
+        used_names = set()
+        done = 0
+        last_report = 0
+        # Images are already compressed, so members are stored as-is
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_STORED) as archive:
+            for future in as_completed(futures):
+                index, item_output, original_name = futures[future]
+                try:
+                    future.result()
+                    archive.write(item_output, unique_archive_name(original_name, used_names))
+                    results[index] = {'name': original_name, 'status': 'completed'}
+                except Exception as e:
+                    results[index] = {'name': original_name, 'status': 'failed', 'error': str(e)}
+                finally:
+                    if os.path.exists(item_output):
+                        os.remove(item_output)
+
+                done += 1
+                if done == total or time.time() - last_report >= 0.5:
+                    last_report = time.time()
+                    update_task_status(task_id, 'processing',
+                                       progress=f'Watermarking {done}/{total}...',
+                                       progress_detail={'percent': done / total * 100,
+                                                        'done': done, 'total': total})
+
+        failed = sum(1 for item in results if item['status'] == 'failed')
+        if failed == total:
+            os.remove(output_path)
+            raise ValueError(results[0]['error'])
+
+        update_task_status(task_id, 'completed', result={
+            'filename': output_filename,
+            'original_name': 'watermarked_images.zip',
+            'type': 'batch',
+            'total': total,
+            'succeeded': total - failed,
+            'failed': failed,
+            'items': results
+        })
+    except Exception as e:
+        update_task_status(task_id, 'failed', error=str(e))
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+
+# ═══════════════════════════════════════════════════════════════
+#  YOUTUBE CACHE (titles, transcripts and summaries in SQLite)
+# ═══════════════════════════════════════════════════════════════
+# Video metadata is keyed by video id; summaries by (video id, prompt, model).
+# Summaries expire after YOUTUBE_SUMMARY_TTL and are evicted least-recently-
+# used past YOUTUBE_SUMMARY_CACHE_MAX_BYTES.
+YOUTUBE_TRANSCRIPT_TTL = int(os.getenv('YOUTUBE_TRANSCRIPT_TTL', 30 * 24 * 3600))
+YOUTUBE_SUMMARY_TTL = int(os.getenv('YOUTUBE_SUMMARY_TTL', 7 * 24 * 3600))
+YOUTUBE_SUMMARY_CACHE_MAX_BYTES = int(os.getenv('YOUTUBE_SUMMARY_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+_youtube_cache_ready = False
+
+
+def youtube_cache_db():
+    global _youtube_cache_ready
+    conn = get_db()
+    if not _youtube_cache_ready:
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS youtube_videos (
+                video_id TEXT PRIMARY KEY,
+                title TEXT,
+                transcript TEXT,
+                language TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS youtube_summaries (
+                cache_key TEXT PRIMARY KEY,
+                video_id TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS youtube_summaries_last_used ON youtube_summaries (last_used);
+        ''')
+        _youtube_cache_ready = True
+    return conn
+
+
+def youtube_video_get(video_id):
+    row = youtube_cache_db().execute(
+        'SELECT title, transcript, language FROM youtube_videos WHERE video_id = ? AND updated_at > ?',
+        (video_id, time.time() - YOUTUBE_TRANSCRIPT_TTL)
+    ).fetchone()
+    if not row:
+        return {}
+    return {'title': row[0], 'transcript': row[1], 'language': row[2]}
+
+
+def youtube_video_put(video_id, **fields):
+    # Only known values are stored; a failed title lookup ('Unknown') is retried next time
+    fields = {k: v for k, v in fields.items() if v and v != 'Unknown'}
+    if not fields:
+        return
+    conn = youtube_cache_db()
+    columns = ', '.join(fields)
+    updates = ', '.join(f'{column} = excluded.{column}' for column in fields)
+    conn.execute(
+        f'INSERT INTO youtube_videos (video_id, {columns}, updated_at) '
+        f'VALUES (?, {", ".join("?" * len(fields))}, ?) '
+        f'ON CONFLICT (video_id) DO UPDATE SET {updates}, updated_at = excluded.updated_at',
+        (video_id, *fields.values(), time.time())
+    )
+    conn.execute('DELETE FROM youtube_videos WHERE updated_at < ?', (time.time() - YOUTUBE_TRANSCRIPT_TTL,))
+
+
+def youtube_summary_key(video_id, prompt, model_name):
+    prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    return hashlib.sha256(f'{video_id}:{prompt_hash}:{model_name}'.encode('utf-8')).hexdigest()
+
+
+def youtube_summary_get(cache_key):
+    conn = youtube_cache_db()
+    row = conn.execute(
+        "SELECT summary FROM youtube_summaries WHERE cache_key = ? AND created_at > ? AND summary != ''",
+        (cache_key, time.time() - YOUTUBE_SUMMARY_TTL)
+    ).fetchone()
+    if row:
+        conn.execute('UPDATE youtube_summaries SET last_used = ? WHERE cache_key = ?', (time.time(), cache_key))
+    count_cache_lookup('youtube_summary', row is not None)
+    return row[0] if row else None
+
+
+def youtube_summary_put(cache_key, video_id, summary):
+    if not summary:
+        return
+    now = time.time()
+    conn = youtube_cache_db()
+    conn.execute(
+        'INSERT OR REPLACE INTO youtube_summaries (cache_key, video_id, summary, size, created_at, last_used) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        (cache_key, video_id, summary, len(summary.encode('utf-8')), now, now)
+    )
+    conn.execute('DELETE FROM youtube_summaries WHERE created_at < ?', (now - YOUTUBE_SUMMARY_TTL,))
+
+    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM youtube_summaries').fetchone()[0]
+    if total > YOUTUBE_SUMMARY_CACHE_MAX_BYTES:
+        for key, size in conn.execute('SELECT cache_key, size FROM youtube_summaries ORDER BY last_used').fetchall():
+            if total <= YOUTUBE_SUMMARY_CACHE_MAX_BYTES or key == cache_key:
+                break
+            conn.execute('DELETE FROM youtube_summaries WHERE cache_key = ?', (key,))
+            total -= size
+
+
+def youtube_cached_result(video_url, custom_prompt=None):
+    # Complete result for a repeated request, without any network call
+    video_id = get_video_id(video_url)
+    video = youtube_video_get(video_id)
+    if not video.get('title') or not video.get('transcript'):
+        return None
+    summary = youtube_summary_get(youtube_summary_key(video_id, summary_prompt(custom_prompt), SUMMARY_MODEL))
+    if not summary:
+        return None
+    return {
+        'title': video['title'],
+        'transcript_preview': video['transcript'][:1000],
+        'summary': summary,
+        'video_url': video_url,
+        'cached': True
+    }
+
+
 # ═══════════════════════════════════════════════════════════════
 #  YOUTUBE SUMMARIZER FUNCTIONS
 # ═══════════════════════════════════════════════════════════════
+SUMMARY_MODEL = os.getenv('GEMINI_SUMMARY_MODEL', 'gemini-2.0-flash')
+SUMMARY_ERROR_PREFIX = 'Error summarizing: '
+# Title, transcript and audio are fetched concurrently. If listing captions
+# takes longer than this, the audio download starts speculatively and is
+# cancelled once a transcript turns up.
+YOUTUBE_AUDIO_PREFETCH_DELAY = float(os.getenv('YOUTUBE_AUDIO_PREFETCH_DELAY', 5))
+
+# Transcripts longer than SUMMARY_CHUNK_TOKENS are summarized map-reduce:
+# chunks split at sentence/caption boundaries are summarized in parallel,
+# then the partial summaries are combined. SUMMARY_CONCURRENCY bounds the
+# Gemini requests in flight per worker; rate-limited calls back off and retry.
+SUMMARY_CHUNK_TOKENS = int(os.getenv('SUMMARY_CHUNK_TOKENS', 8000))
+SUMMARY_CONCURRENCY = int(os.getenv('SUMMARY_CONCURRENCY', 4))
+SUMMARY_MAX_RETRIES = 5
+SUMMARY_RETRY_BASE = 2.0
+SUMMARY_RETRY_MAX = 60.0
+RETRYABLE_STATUS_CODES = (429, 500, 503, 504)
+SENTENCE_BOUNDARY_RE = re.compile(r'\n+|(?<=[.!?…])\s+')
+MAP_SUMMARY_PROMPT = ("Đây là phần {part}/{parts} của transcript một video. Hãy tóm tắt chi tiết các ý chính, "
+                      "số liệu và ví dụ quan trọng của phần này bằng tiếng Việt.")
+REDUCE_SUMMARY_PROMPT = "Hãy gộp các bản tóm tắt sau thành một bản tóm tắt duy nhất, giữ đầy đủ các ý chính."
+
+# Videos without captions are transcribed from their audio, re-encoded to
+# 16 kHz mono Opus (a few MB per hour) and cut into TRANSCRIBE_SEGMENT_SECONDS
+# segments that are uploaded and transcribed in parallel, then joined.
+TRANSCRIBE_MODEL = os.getenv('GEMINI_TRANSCRIBE_MODEL', 'gemini-1.5-flash')
+TRANSCRIBE_PROMPT = "Please transcribe this audio accurately. Output only the transcript."
+TRANSCRIBE_SEGMENT_SECONDS = int(os.getenv('TRANSCRIBE_SEGMENT_SECONDS', 600))
+TRANSCRIBE_AUDIO_BITRATE = '24k'
+TRANSCRIBE_TIMEOUT = 600
+GEMINI_FILE_POLL_START = 0.5
+GEMINI_FILE_POLL_MAX = 10.0
+
+# The final summary request is streamed and its text published to the task
+# as it arrives, at most every SUMMARY_STREAM_INTERVAL seconds.
+SUMMARY_STREAM = os.getenv('SUMMARY_STREAM', '1') == '1'
+SUMMARY_STREAM_INTERVAL = 0.5
+
+_gemini_slots = threading.BoundedSemaphore(SUMMARY_CONCURRENCY)
+DEFAULT_SUMMARY_PROMPT = "Hãy tóm tắt chi tiết, đầy đủ các ý chính của video sau bằng tiếng Việt. Trình bày rõ ràng, dễ hiểu."
+
 def get_video_id(url):
     if "v=" in url:
         return url.split("v=")[1].split("&")[0]
@@ -236,12 +1240,14 @@ def get_video_id(url):
 
 
 def get_transcript(video_id):
+    # Returns (text, language code), or (None, None) without a transcript
     try:
         from youtube_transcript_api import YouTubeTranscriptApi
         from youtube_transcript_api.formatters import TextFormatter
 
         api = YouTubeTranscriptApi()
-        transcript_list = api.list(video_id)
+        with timed('youtube_transcript'):
+            transcript_list = api.list(video_id)
 
         transcript = None
         try:
@@ -256,105 +1262,387 @@ def get_transcript(video_id):
 
         if transcript:
             formatter = TextFormatter()
-            text_formatted = formatter.format_transcript(transcript.fetch())
-            return text_formatted
+            with timed('youtube_transcript'):
+                fetched = transcript.fetch()
+            text_formatted = formatter.format_transcript(fetched)
+            return text_formatted, transcript.language_code
     except Exception as e:
         print(f"Could not retrieve transcript: {e}")
-        return None
+    return None, None
 
 
 def get_video_title_yt(url):
     try:
         import yt_dlp
-        with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
+        with timed('ytdlp_metadata'), yt_dlp.YoutubeDL({'quiet': True}) as ydl:
             info = ydl.extract_info(url, download=False)
             return info.get('title', 'Unknown')
     except Exception:
         return 'Unknown'
 
 
-def download_audio_and_transcribe(url, api_key):
+class DownloadCancelled(Exception):
+    pass
+
+
+def download_audio(url, cancel_event=None, on_progress=None):
+    # Returns the path of the downloaded audio stream as served (no
+    # re-encode here), or None if it failed or cancel_event was set first
+    # (partial files are removed). on_progress(label, percent or None)
+    # follows the download and any yt-dlp postprocessing (e.g. container
+    # fixups), which can also be cancelled.
+    import yt_dlp
+
+    output_base = os.path.join(UPLOAD_FOLDER, f"temp_audio_{uuid.uuid4().hex}")
+    last_report = {'at': 0.0}
+
+    def check_cancelled(_status):
+        if cancel_event is not None and cancel_event.is_set():
+            raise DownloadCancelled()
+
+    def download_progress(status):
+        check_cancelled(status)
+        now = time.monotonic()
+        if on_progress is None or status.get('status') != 'downloading' \
+                or now - last_report['at'] < FFMPEG_REPORT_INTERVAL:
+            return
+        last_report['at'] = now
+        total = status.get('total_bytes') or status.get('total_bytes_estimate')
+        on_progress('Downloading audio...', status.get('downloaded_bytes', 0) * 100 / total if total else None)
+
+    def postprocessor_progress(status):
+        check_cancelled(status)
+        if on_progress and status.get('status') == 'started':
+            on_progress(f"Processing audio ({status.get('postprocessor')})...", None)
+
+    ydl_opts = {
+        'format': 'bestaudio/best',
+        'outtmpl': output_base + '.%(ext)s',
+        'progress_hooks': [download_progress],
+        'postprocessor_hooks': [postprocessor_progress],
+        'quiet': True,
+        'noprogress': True
+    }
+
     try:
-        import yt_dlp
-        import google.generativeai as genai
-
-        output_filename = os.path.join(UPLOAD_FOLDER, f"temp_audio_{uuid.uuid4().hex}.mp3")
-
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'outtmpl': output_filename.replace('.mp3', '.%(ext)s'),
-            'quiet': True,
-            'noprogress': True
-        }
+        with timed('ytdlp_download'), yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=True)
+            output_filename = ydl.prepare_filename(info)
+        check_cancelled(None)
+        return output_filename
+    except Exception as e:
+        if not isinstance(e, DownloadCancelled):
+            print(f"Error downloading audio: {e}")
+        for name in os.listdir(UPLOAD_FOLDER):
+            if name.startswith(os.path.basename(output_base)):
+                os.remove(os.path.join(UPLOAD_FOLDER, name))
+        return None
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
 
-        genai.configure(api_key=api_key)
-        audio_file = genai.upload_file(output_filename)
+def discard_audio(audio_future):
+    if audio_future.cancelled() or audio_future.exception():
+        return
+    audio_path = audio_future.result()
+    if audio_path and os.path.exists(audio_path):
+        os.remove(audio_path)
+
+
+def encode_speech_segments(input_path, output_dir):
+    # Speech recognition needs neither stereo nor 192 kbps
+    pattern = os.path.join(output_dir, 'segment_%04d.ogg')
+    run_ffmpeg([
+        'ffmpeg', '-v', 'error', '-nostdin',
+        '-i', input_path,
+        '-vn', '-ac', '1', '-ar', '16000',
+        '-c:a', 'libopus', '-b:a', TRANSCRIBE_AUDIO_BITRATE, '-application', 'voip',
+        '-f', 'segment', '-segment_time', str(TRANSCRIBE_SEGMENT_SECONDS), '-reset_timestamps', '1',
+        pattern
+    ])
+    return sorted(os.path.join(output_dir, name) for name in os.listdir(output_dir))
+
+
+def wait_for_gemini_file(genai, audio_file):
+    # Polls with exponential backoff instead of a fixed interval
+    delay = GEMINI_FILE_POLL_START
+    deadline = time.monotonic() + TRANSCRIBE_TIMEOUT
+    while audio_file.state.name == "PROCESSING":
+        if time.monotonic() > deadline:
+            raise TimeoutError("Gemini did not finish processing the audio in time")
+        time.sleep(delay)
+        delay = min(delay * 2, GEMINI_FILE_POLL_MAX)
+        audio_file = genai.get_file(audio_file.name)
+    if audio_file.state.name == "FAILED":
+        raise RuntimeError("Gemini could not process the audio")
+    return audio_file
+
+
+def transcribe_segment(genai, model, segment_path):
+    with timed('gemini_upload'):
+        audio_file = genai.upload_file(segment_path, mime_type='audio/ogg')
+    try:
+        with timed('gemini_upload'):
+            audio_file = wait_for_gemini_file(genai, audio_file)
+        return generate_with_retry(model, [audio_file, TRANSCRIBE_PROMPT],
+                                   request_options={"timeout": TRANSCRIBE_TIMEOUT})
+    finally:
+        try:
+            genai.delete_file(audio_file.name)
+        except Exception:
+            pass
 
-        while audio_file.state.name == "PROCESSING":
-            time.sleep(2)
-            audio_file = genai.get_file(audio_file.name)
 
-        if audio_file.state.name == "FAILED":
-            return None
+def transcribe_audio(audio_path, api_key):
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(TRANSCRIBE_MODEL)
 
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        response = model.generate_content(
-            [audio_file, "Please transcribe this audio accurately. Output only the transcript."],
-            request_options={"timeout": 600}
-        )
+    segment_dir = tempfile.mkdtemp(prefix='transcribe_', dir=UPLOAD_FOLDER)
+    try:
+        segments = encode_speech_segments(audio_path, segment_dir)
+        if not segments:
+            return None
+        executor = ThreadPoolExecutor(max_workers=min(SUMMARY_CONCURRENCY, len(segments)))
+        try:
+            texts = list(executor.map(lambda path: transcribe_segment(genai, model, path), segments))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        return '\n'.join(text.strip() for text in texts if text)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
 
-        if os.path.exists(output_filename):
-            os.remove(output_filename)
 
-        return response.text
+def download_audio_and_transcribe(url, api_key, audio_path=None):
+    # audio_path: an already downloaded (prefetched) file to transcribe.
+    # The audio is removed afterwards, whatever happens.
+    audio_path = audio_path or download_audio(url)
+    if not audio_path:
+        return None
+    try:
+        return transcribe_audio(audio_path, api_key)
     except Exception as e:
         print(f"Error in download/transcribe: {e}")
         return None
+    finally:
+        if os.path.exists(audio_path):
+            os.remove(audio_path)
+
+
+def summary_prompt(custom_prompt=None):
+    return custom_prompt or DEFAULT_SUMMARY_PROMPT
+
+
+def estimate_tokens(text):
+    # Roughly 4 bytes of UTF-8 per token: plain ASCII ~4 chars, Vietnamese
+    # with diacritics comes out heavier, which matches the tokenizer better
+    # than a character count.
+    return len(text.encode('utf-8')) // 4 + 1
+
+
+def split_transcript(text, max_tokens):
+    chunks = []
+    current = []
+    current_tokens = 0
+    for unit in SENTENCE_BOUNDARY_RE.split(text):
+        unit = unit.strip()
+        if not unit:
+            continue
+        tokens = estimate_tokens(unit)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(' '.join(current))
+            current, current_tokens = [], 0
+        if tokens > max_tokens:
+            # A "sentence" without punctuation (e.g. raw auto captions)
+            step = max(1, len(unit) * max_tokens // tokens)
+            chunks.extend(unit[i:i + step] for i in range(0, len(unit), step))
+            continue
+        current.append(unit)
+        current_tokens += tokens
+    if current:
+        chunks.append(' '.join(current))
+    return chunks
+
+
+def is_retryable_error(e):
+    # google.api_core errors carry the HTTP status as .code
+    code = getattr(e, 'code', None)
+    return code in RETRYABLE_STATUS_CODES or type(e).__name__ in (
+        'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'DeadlineExceeded', 'InternalServerError'
+    )
 
 
-def summarize_text(text, api_key, custom_prompt=None):
+def generate_streamed(model, prompt, on_text):
+    # on_text(text so far) after every streamed chunk
+    text = ''
+    for chunk in model.generate_content(prompt, stream=True):
+        try:
+            text += chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. only a finish reason)
+            continue
+        on_text(text)
     if not text:
-        return "No text to summarize."
+        # Every chunk lacked text, e.g. a response blocked by safety filters
+        raise ValueError('The model returned no text')
+    return text
+
 
+def generate_with_retry(model, prompt, on_text=None, request_options=None):
+    # A retried stream starts over; on_text then sees the text restart
+    options = {'request_options': request_options} if request_options else {}
+    for attempt in range(SUMMARY_MAX_RETRIES + 1):
+        try:
+            with _gemini_slots, timed('gemini_generate'):
+                if on_text:
+                    return generate_streamed(model, prompt, on_text)
+                return model.generate_content(prompt, **options).text
+        except Exception as e:
+            if attempt == SUMMARY_MAX_RETRIES or not is_retryable_error(e):
+                raise
+            delay = min(SUMMARY_RETRY_BASE * 2 ** attempt, SUMMARY_RETRY_MAX)
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+
+def generate_all(model, prompts, on_done=None):
+    # Runs prompts in parallel, results in order; on_done() after each one
+    if len(prompts) == 1:
+        results = [generate_with_retry(model, prompts[0])]
+        if on_done:
+            on_done()
+        return results
+
+    results = [None] * len(prompts)
+    executor = ThreadPoolExecutor(max_workers=min(SUMMARY_CONCURRENCY, len(prompts)))
     try:
-        import google.generativeai as genai
-        genai.configure(api_key=api_key)
+        futures = {executor.submit(generate_with_retry, model, prompt): i for i, prompt in enumerate(prompts)}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            if on_done:
+                on_done()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return results
 
-        model = genai.GenerativeModel("gemini-2.0-flash")
 
-        if custom_prompt:
-            base_prompt = custom_prompt
-        else:
-            base_prompt = "Hãy tóm tắt chi tiết, đầy đủ các ý chính của video sau bằng tiếng Việt. Trình bày rõ ràng, dễ hiểu."
+def gemini_model(api_key):
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(SUMMARY_MODEL)
 
-        prompt = f"{base_prompt}\n\nNội dung Transcript:\n{text[:30000]}"
-        response = model.generate_content(prompt)
-        return response.text
+
+def summarize_text(text, api_key, custom_prompt=None, model=None, on_progress=None, on_partial=None):
+    # model: anything with generate_content(prompt) -> response with .text,
+    # and generate_content(prompt, stream=True) -> chunks with .text when
+    # on_partial is given (a Gemini GenerativeModel by default).
+    # on_progress(done, total) counts Gemini requests; on_partial(text)
+    # receives the final summary while it is being generated.
+    if not text:
+        return "No text to summarize."
+
+    try:
+        model = model or gemini_model(api_key)
+        base_prompt = summary_prompt(custom_prompt)
+
+        chunks = split_transcript(text, SUMMARY_CHUNK_TOKENS)
+        if len(chunks) <= 1:
+            return generate_with_retry(model, f"{base_prompt}\n\nNội dung Transcript:\n{text}", on_partial)
+
+        progress = {'done': 0, 'total': len(chunks) + 1}
+
+        def request_done():
+            progress['done'] += 1
+            if on_progress:
+                on_progress(progress['done'], progress['total'])
+
+        # Map: every chunk on its own
+        partials = generate_all(model, [
+            f"{MAP_SUMMARY_PROMPT.format(part=i, parts=len(chunks))}\n\nNội dung Transcript:\n{chunk}"
+            for i, chunk in enumerate(chunks, 1)
+        ], request_done)
+
+        # Reduce: combine partial summaries until they fit in one request
+        while estimate_tokens('\n\n'.join(partials)) > SUMMARY_CHUNK_TOKENS and len(partials) > 1:
+            groups = split_summaries(partials, SUMMARY_CHUNK_TOKENS)
+            progress['total'] += len(groups)
+            partials = generate_all(model, [
+                f"{REDUCE_SUMMARY_PROMPT}\n\n" + '\n\n'.join(group) for group in groups
+            ], request_done)
+
+        combined = '\n\n'.join(f"[Phần {i}]\n{partial}" for i, partial in enumerate(partials, 1))
+        summary = generate_with_retry(model, f"{base_prompt}\n\nNội dung (tóm tắt từng phần của video):\n{combined}",
+                                      on_partial)
+        request_done()
+        return summary
     except Exception as e:
-        return f"Error summarizing: {e}"
+        return f"{SUMMARY_ERROR_PREFIX}{e}"
+
+
+def split_summaries(partials, max_tokens):
+    # Groups whole partial summaries (at least two per group so every round shrinks)
+    groups = [[]]
+    group_tokens = 0
+    for partial in partials:
+        tokens = estimate_tokens(partial)
+        if len(groups[-1]) >= 2 and group_tokens + tokens > max_tokens:
+            groups.append([])
+            group_tokens = 0
+        groups[-1].append(partial)
+        group_tokens += tokens
+    return groups
 
 
 def process_youtube_task(task_id, video_url, api_key, custom_prompt=None):
     try:
-        update_task_status(task_id, 'processing', progress='Getting video title...')
-        title = get_video_title_yt(video_url)
+        cached = youtube_cached_result(video_url, custom_prompt)
+        if cached:
+            update_task_status(task_id, 'completed', result=cached)
+            return
+
+        video_id = get_video_id(video_url)
+        video = youtube_video_get(video_id)
+    except Exception as e:
+        update_task_status(task_id, 'failed', error=str(e))
+        return
+
+    # The title is only needed for the final result, so it is fetched
+    # alongside everything else; latency is the slowest path, not the sum.
+    executor = ThreadPoolExecutor(max_workers=3)
+    cancel_audio = threading.Event()
+    audio_future = None
+    # A speculative prefetch stays quiet until the audio is actually needed
+    report_audio = threading.Event()
+
+    def audio_progress(label, percent):
+        if report_audio.is_set():
+            update_task_status(task_id, 'processing', progress=label,
+                               progress_detail={'percent': percent} if percent is not None else None)
+    try:
+        title_future = None
+        if not video.get('title'):
+            title_future = executor.submit(get_video_title_yt, video_url)
 
         update_task_status(task_id, 'processing', progress='Extracting transcript...')
-        video_id = get_video_id(video_url)
-        full_text = get_transcript(video_id)
+        full_text, language = video.get('transcript'), video.get('language')
+        if not full_text:
+            transcript_future = executor.submit(get_transcript, video_id)
+            try:
+                full_text, language = transcript_future.result(timeout=YOUTUBE_AUDIO_PREFETCH_DELAY)
+            except TimeoutError:
+                audio_future = executor.submit(download_audio, video_url, cancel_audio, audio_progress)
+                full_text, language = transcript_future.result()
+            if full_text:
+                cancel_audio.set()
 
         if not full_text:
             update_task_status(task_id, 'processing',
                                progress='No transcript found. Downloading audio for AI transcription...')
-            full_text = download_audio_and_transcribe(video_url, api_key)
+            report_audio.set()
+            if audio_future is None:
+                audio_future = executor.submit(download_audio, video_url, cancel_audio, audio_progress)
+            audio_path = audio_future.result()
+            report_audio.clear()
+            if audio_path:
+                update_task_status(task_id, 'processing', progress='Transcribing audio with Gemini AI...')
+                full_text = download_audio_and_transcribe(video_url, api_key, audio_path)
 
         if not full_text:
             update_task_status(task_id, 'failed',
@@ -362,7 +1650,31 @@ def process_youtube_task(task_id, video_url, api_key, custom_prompt=None):
             return
 
         update_task_status(task_id, 'processing', progress='Summarizing with Gemini AI...')
-        summary = summarize_text(full_text, api_key, custom_prompt)
+
+        def summary_progress(done, total):
+            update_task_status(task_id, 'processing', progress=f'Summarizing with Gemini AI... ({done}/{total})',
+                               progress_detail={'percent': done / total * 100, 'done': done, 'total': total})
+
+        last_partial = {'at': 0}
+
+        def summary_partial(text):
+            now = time.monotonic()
+            if now - last_partial['at'] < SUMMARY_STREAM_INTERVAL:
+                return
+            last_partial['at'] = now
+            partial = {'summary': text, 'partial': True}
+            if title_future is None or title_future.done():
+                partial['title'] = title_future.result() if title_future else video['title']
+            update_task_status(task_id, 'processing', progress='Summarizing with Gemini AI...', result=partial)
+
+        summary = summarize_text(full_text, api_key, custom_prompt, on_progress=summary_progress,
+                                 on_partial=summary_partial if SUMMARY_STREAM else None)
+
+        title = title_future.result() if title_future else video['title']
+        youtube_video_put(video_id, title=title, transcript=full_text, language=language)
+        if summary and not summary.startswith(SUMMARY_ERROR_PREFIX):
+            youtube_summary_put(youtube_summary_key(video_id, summary_prompt(custom_prompt), SUMMARY_MODEL),
+                                video_id, summary)
 
         update_task_status(task_id, 'completed', result={
             'title': title,
@@ -373,84 +1685,452 @@ def process_youtube_task(task_id, video_url, api_key, custom_prompt=None):
 
     except Exception as e:
         update_task_status(task_id, 'failed', error=str(e))
+    finally:
+        cancel_audio.set()
+        if audio_future is not None:
+            # A prefetch that finished after all is not needed any more
+            audio_future.add_done_callback(discard_audio)
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 # ═══════════════════════════════════════════════════════════════
 #  CONTACT SHEET FUNCTIONS
 # ═══════════════════════════════════════════════════════════════
-def get_video_duration(video_path):
-    cmd = [
-        "ffprobe",
-        "-v", "quiet",
-        "-print_format", "json",
-        "-show_format",
-        "-show_streams",
-        video_path
-    ]
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        data = json.loads(result.stdout)
-
-        if 'format' in data and 'duration' in data['format']:
-            return float(data['format']['duration'])
+# How frames are pulled from the video:
+#   filter   - decode the whole file through fps/scale/tile (exact, slowest)
+#   seek     - one input-side -ss per timestamp, decoding only from the
+#              preceding keyframe (exact)
+#   keyframe - nearest keyframe at or before each timestamp, decoding
+#              nothing else (approximate timing, fastest)
+# seek and keyframe run CONTACT_SHEET_WORKERS ffmpeg processes at once and
+# assemble the grid in memory.
+CONTACT_SHEET_EXTRACT_MODES = ('filter', 'seek', 'keyframe')
+CONTACT_SHEET_EXTRACT = os.getenv('CONTACT_SHEET_EXTRACT', 'seek')
+CONTACT_SHEET_WORKERS = int(os.getenv('CONTACT_SHEET_WORKERS', 0)) or os.cpu_count() or 1
+CONTACT_SHEET_QUALITY = 90
+
+# Long videos are split over several pages so no single JPEG grows past
+# CONTACT_SHEET_MAX_PAGE_PIXELS (or the JPEG dimension limit). Multi-page
+# sheets are delivered as a zip of JPEGs or as one PDF.
+CONTACT_SHEET_MAX_PAGE_PIXELS = int(os.getenv('CONTACT_SHEET_MAX_PAGE_PIXELS', 25_000_000))
+CONTACT_SHEET_MAX_TILES = int(os.getenv('CONTACT_SHEET_MAX_TILES', 5000))
+CONTACT_SHEET_FORMATS = ('zip', 'pdf')
+JPEG_MAX_DIMENSION = 65500
+PDF_MAX_PAGE_POINTS = 14400
+
+# mode=scene places a tile at every cut instead of every interval seconds.
+# The video is decoded once at SCENE_SAMPLE_FPS into tiny RGB frames whose
+# 8x8x8 colour histograms are compared in batches; a cut is a histogram
+# distance (0..1) above SCENE_THRESHOLD. Cuts that look like a shot already
+# on the sheet (below SCENE_DUPLICATE_THRESHOLD) are dropped.
+CONTACT_SHEET_MODES = ('interval', 'scene')
+SCENE_SAMPLE_FPS = float(os.getenv('SCENE_SAMPLE_FPS', 4))
+SCENE_SAMPLE_SIZE = (64, 36)
+SCENE_BATCH_FRAMES = 256
+SCENE_THRESHOLD = float(os.getenv('SCENE_THRESHOLD', 0.35))
+SCENE_DUPLICATE_THRESHOLD = float(os.getenv('SCENE_DUPLICATE_THRESHOLD', 0.15))
 
-        for stream in data.get('streams', []):
-            if stream.get('codec_type') == 'video' and 'duration' in stream:
-                return float(stream['duration'])
 
-        raise ValueError("Could not determine video duration")
-    except Exception as e:
+def get_video_duration(video_path):
+    try:
+        duration = probe_video(video_path)['duration']
+    except (OSError, ValueError) as e:
         raise Exception(f"Error getting video duration: {e}")
-
-
-def create_contact_sheet(video_path, interval=3, width=320, cols=5, output_path=None):
+    if not duration:
+        raise Exception("Error getting video duration: Could not determine video duration")
+    return duration
+
+
+def extract_frame(video_path, timestamp, width, keyframe=False):
+    # Returns the frame at timestamp scaled to width, or None when nothing
+    # can be decoded there. With -skip_frame nokey, ffmpeg returns nothing
+    # after the last keyframe, so keyframe mode retries without it, and the
+    # seek still lands on that keyframe.
+    frame = _extract_frame(video_path, timestamp, width, keyframe, keyframe)
+    if frame is None and keyframe:
+        frame = _extract_frame(video_path, timestamp, width, True, False)
+    return frame
+
+
+def _extract_frame(video_path, timestamp, width, approximate, keyframes_only):
+    cmd = ["ffmpeg", "-v", "error", "-nostdin"]
+    if keyframes_only:
+        cmd += ["-skip_frame", "nokey"]
+    if approximate:
+        cmd += ["-noaccurate_seek"]
+    cmd += [
+        "-ss", f"{timestamp:.3f}",
+        "-i", video_path,
+        "-map", "0:v:0",
+        "-frames:v", "1",
+        "-vf", f"scale={width}:-1",
+        "-f", "image2pipe",
+        "-c:v", "ppm",
+        "-"
+    ]
+    with timed('ffmpeg_frame'):
+        result = subprocess.run(cmd, capture_output=True, timeout=FFMPEG_STALL_TIMEOUT)
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
+    if not result.stdout:
+        return None
+    frame = Image.open(io.BytesIO(result.stdout))
+    frame.load()
+    return frame
+
+
+def extract_frames(video_path, timestamps, width, keyframe=False, on_progress=None,
+                   progress_offset=0, progress_total=None):
+    # Returns the frames in timestamp order; timestamps that yield no frame
+    # (past the last decodable one) are left out rather than drawn black.
+    # progress_offset/progress_total place this batch within a larger job.
+    total = progress_total or len(timestamps)
+    frames = [None] * len(timestamps)
+    started = time.monotonic()
+    last_report = 0
+    executor = ThreadPoolExecutor(max_workers=min(CONTACT_SHEET_WORKERS, len(timestamps)))
+    try:
+        futures = {
+            executor.submit(extract_frame, video_path, t, width, keyframe): i
+            for i, t in enumerate(timestamps)
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            frames[futures[future]] = future.result()
+
+            now = time.monotonic()
+            if on_progress and (now - last_report >= FFMPEG_REPORT_INTERVAL or done == len(timestamps)):
+                last_report = now
+                rate = done / max(now - started, 1e-6)
+                on_progress((progress_offset + done) * 100 / total, round(rate, 1),
+                            (total - progress_offset - done) / rate)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return [frame for frame in frames if frame is not None]
+
+
+def assemble_contact_sheet(frames, cols, output_path):
+    tile_w, tile_h = frames[0].size
+    rows = math.ceil(len(frames) / cols)
+    sheet = Image.new('RGB', (tile_w * cols, tile_h * rows))
+    for i, frame in enumerate(frames):
+        sheet.paste(frame, ((i % cols) * tile_w, (i // cols) * tile_h))
+    sheet.save(output_path, quality=CONTACT_SHEET_QUALITY)
+
+
+def contact_sheet_timestamps(duration, interval, target_tiles=None):
+    # Returns (timestamps, effective interval). With target_tiles the interval
+    # adapts to the video: samples are spread evenly, centred in their slot.
+    if target_tiles:
+        interval = duration / target_tiles
+        timestamps = [interval * (i + 0.5) for i in range(target_tiles)]
+    else:
+        # Strictly before the end: nothing can be decoded at t == duration
+        timestamps = [i * interval for i in range(math.ceil(duration / interval))]
+    if len(timestamps) > CONTACT_SHEET_MAX_TILES:
+        raise ValueError(f"{len(timestamps)} frames exceeds the limit of {CONTACT_SHEET_MAX_TILES}; "
+                         f"use a longer interval or target_tiles")
+    return timestamps, interval
+
+
+def contact_sheet_rows_per_page(video_path, width, cols):
+    info = probe_video(video_path)
+    tile_height = max(1, round(width * info['height'] / info['width']))
+    return max(1, min(CONTACT_SHEET_MAX_PAGE_PIXELS // (width * cols * tile_height),
+                      JPEG_MAX_DIMENSION // tile_height))
+
+
+def frame_histograms(frames):
+    # (n, h, w, 3) uint8 frames -> (n, 512) normalised 8x8x8 RGB histograms,
+    # counted for the whole batch with one bincount
+    import numpy as np
+    n = frames.shape[0]
+    quantized = (frames >> 5).astype(np.int32)
+    bins = (quantized[..., 0] << 6) | (quantized[..., 1] << 3) | quantized[..., 2]
+    bins = bins.reshape(n, -1) + (np.arange(n, dtype=np.int32) * 512)[:, None]
+    counts = np.bincount(bins.ravel(), minlength=n * 512).reshape(n, 512)
+    return counts / bins.shape[1]
+
+
+def detect_scenes(video_path, threshold=SCENE_THRESHOLD, on_progress=None):
+    # Returns [(timestamp, histogram, score)] for the first frame and every cut
+    import numpy as np
+    sample_w, sample_h = SCENE_SAMPLE_SIZE
+    frame_bytes = sample_w * sample_h * 3
+    cmd = [
+        "ffmpeg", "-v", "error", "-nostdin",
+        "-i", video_path,
+        "-map", "0:v:0",
+        "-vf", f"fps={SCENE_SAMPLE_FPS},scale={sample_w}:{sample_h}",
+        "-f", "rawvideo",
+        "-pix_fmt", "rgb24",
+        "-"
+    ]
+    expected = max(1, int(get_video_duration(video_path) * SCENE_SAMPLE_FPS))
+    started = time.monotonic()
+
+    scenes = []
+    previous = None
+    index = 0
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            while True:
+                data = proc.stdout.read(frame_bytes * SCENE_BATCH_FRAMES)
+                n = len(data) // frame_bytes
+                if n == 0:
+                    break
+                frames = np.frombuffer(data, np.uint8, n * frame_bytes).reshape(n, sample_h, sample_w, 3)
+                hists = frame_histograms(frames)
+
+                # Distance of every frame to the one before it, across batches
+                before = np.vstack([hists[:1] if previous is None else previous, hists[:-1]])
+                scores = np.abs(hists - before).sum(axis=1) / 2
+                if previous is None:
+                    scores[0] = 1.0
+                for i in np.flatnonzero(scores > threshold):
+                    scenes.append((float(index + i) / SCENE_SAMPLE_FPS, hists[i], float(scores[i])))
+
+                previous = hists[-1:]
+                index += n
+                if on_progress:
+                    rate = index / max(time.monotonic() - started, 1e-6)
+                    on_progress(min(index * 100 / expected, 100), round(rate, 1),
+                                max(expected - index, 0) / rate)
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+        if proc.returncode != 0:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(proc.returncode, cmd,
+                                                stderr=stderr.read().decode(errors='replace'))
+    return scenes
+
+
+def dedupe_scenes(scenes, threshold=SCENE_DUPLICATE_THRESHOLD):
+    # Drops cuts back to a shot that is already on the sheet (e.g. the two
+    # cameras of an interview); each cut is checked against all kept ones at once
+    import numpy as np
+    kept = []
+    kept_hists = np.empty((len(scenes), 512))
+    for timestamp, hist, score in scenes:
+        if kept and np.abs(kept_hists[:len(kept)] - hist).sum(axis=1).min() / 2 < threshold:
+            continue
+        kept_hists[len(kept)] = hist
+        kept.append((timestamp, score))
+    return kept
+
+
+def scene_timestamps(video_path, target_tiles=None, on_progress=None):
+    scenes = dedupe_scenes(detect_scenes(video_path, on_progress=on_progress))
+    limit = min(target_tiles or CONTACT_SHEET_MAX_TILES, CONTACT_SHEET_MAX_TILES)
+    if len(scenes) > limit:
+        # Keep the strongest cuts (the first frame always scores 1.0)
+        scenes = sorted(sorted(scenes, key=lambda scene: -scene[1])[:limit])
+    return [timestamp for timestamp, _ in scenes]
+
+
+def create_contact_sheet(video_path, interval=3, width=320, cols=5, output_path=None,
+                         on_progress=None, extract=None, target_tiles=None, on_page=None,
+                         timestamps=None):
+    # Returns (page paths, frames on them): output_path itself when the
+    # sheet fits on one page, otherwise <base>_p001.jpg, <base>_p002.jpg, ...
+    # on_page(path, number, count) is called as each page is written.
+    # timestamps overrides interval sampling (e.g. scene cuts).
     if output_path is None:
         base, _ = os.path.splitext(video_path)
         output_path = f"{base}_contact_sheet.jpg"
+    extract = extract or CONTACT_SHEET_EXTRACT
 
     duration = get_video_duration(video_path)
-    num_frames = int(duration / interval) + 1
-    rows = math.ceil(num_frames / cols)
-
-    vf_filter = f"fps=1/{interval},scale={width}:-1,tile={cols}x{rows}"
+    if timestamps is None:
+        timestamps, interval = contact_sheet_timestamps(duration, interval, target_tiles)
+    elif extract == 'filter':
+        # The filter graph can only sample at a fixed rate
+        extract = 'seek'
+    if not timestamps:
+        raise ValueError("No frames could be extracted from the video")
+    rows = math.ceil(len(timestamps) / cols)
+    rows_per_page = min(rows, contact_sheet_rows_per_page(video_path, width, cols))
+    per_page = rows_per_page * cols
+
+    page_count = math.ceil(len(timestamps) / per_page)
+    base, ext = os.path.splitext(output_path)
+    if page_count == 1:
+        page_paths = [output_path]
+    else:
+        page_paths = [f"{base}_p{n:03d}{ext}" for n in range(1, page_count + 1)]
+
+    if extract != 'filter':
+        written = []
+        frame_count = 0
+        for n in range(page_count):
+            page_timestamps = timestamps[n * per_page:(n + 1) * per_page]
+            frames = extract_frames(video_path, page_timestamps, width, extract == 'keyframe',
+                                    on_progress, n * per_page, len(timestamps))
+            if not frames:
+                continue
+            # Pages are numbered by what was written, so a skipped page leaves no gap
+            page_path = page_paths[len(written)]
+            assemble_contact_sheet(frames, cols, page_path)
+            written.append(page_path)
+            frame_count += len(frames)
+            if on_page:
+                on_page(page_path, len(written), page_count)
+        return single_page_name(written, output_path), frame_count
+
+    # tile only emits a page once it is full (or at the end); showinfo logs
+    # each sampled frame so run_ffmpeg can follow along.
+    showinfo = ",showinfo" if on_progress else ""
+    vf_filter = f"fps=1/{interval}{showinfo},scale={width}:-1,tile={cols}x{rows_per_page}"
 
     cmd = [
         "ffmpeg",
         "-i", video_path,
         "-vf", vf_filter,
-        "-frames:v", "1",
+        "-frames:v", str(page_count),
         "-y",
-        output_path
     ]
-
-    subprocess.run(cmd, check=True, capture_output=True)
-    return output_path
-
-
-def process_contact_sheet_task(task_id, input_path, interval, width, cols, original_filename):
+    if page_count == 1:
+        cmd.append(output_path)
+    else:
+        cmd += ["-start_number", "1", f"{base}_p%03d{ext}"]
+
+    run_ffmpeg(cmd, duration, on_progress)
+    page_paths = single_page_name([path for path in page_paths if os.path.exists(path)], output_path)
+    if on_page:
+        for n, page_path in enumerate(page_paths):
+            on_page(page_path, n + 1, len(page_paths))
+    return page_paths, min(len(timestamps), len(page_paths) * per_page)
+
+
+def single_page_name(page_paths, output_path):
+    # A sheet planned over several pages can end up on one (the video ran
+    # out of frames early); it then gets the plain single-page name
+    if not page_paths:
+        raise ValueError("No frames could be extracted from the video")
+    if len(page_paths) == 1 and page_paths[0] != output_path:
+        os.replace(page_paths[0], output_path)
+        return [output_path]
+    return page_paths
+
+
+def write_jpeg_pdf(page_paths, output_path):
+    # Embeds the JPEG pages as they are (DCTDecode): nothing is re-encoded
+    # and only one page is in memory at a time.
+    offsets = []
+    with open(output_path, 'wb') as out:
+        def write_object(body):
+            offsets.append(out.tell())
+            out.write(f"{len(offsets)} 0 obj\n".encode() + body + b"\nendobj\n")
+
+        out.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        kids = ' '.join(f"{3 + 3 * n} 0 R" for n in range(len(page_paths)))
+        write_object(b"<< /Type /Catalog /Pages 2 0 R >>")
+        write_object(f"<< /Type /Pages /Kids [{kids}] /Count {len(page_paths)} >>".encode())
+
+        for n, page_path in enumerate(page_paths):
+            with Image.open(page_path) as img:
+                width, height = img.size
+            # 1px = 1pt, scaled down past the largest page size viewers accept
+            scale = min(1, PDF_MAX_PAGE_POINTS / max(width, height))
+            page_w, page_h = round(width * scale, 2), round(height * scale, 2)
+            content = f"q {page_w} 0 0 {page_h} 0 0 cm /Im0 Do Q".encode()
+            with open(page_path, 'rb') as f:
+                data = f.read()
+
+            write_object(
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_w} {page_h}] "
+                f"/Resources << /XObject << /Im0 {4 + 3 * n} 0 R >> >> /Contents {5 + 3 * n} 0 R >>".encode()
+            )
+            write_object(
+                f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode "
+                f"/Length {len(data)} >>\nstream\n".encode() + data + b"\nendstream"
+            )
+            write_object(f"<< /Length {len(content)} >>\nstream\n".encode() + content + b"\nendstream")
+
+        xref = out.tell()
+        out.write(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode())
+        for offset in offsets:
+            out.write(f"{offset:010d} 00000 n \n".encode())
+        out.write(f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+
+
+def package_contact_sheet(page_paths, output_path, output_format):
+    if output_format == 'pdf':
+        write_jpeg_pdf(page_paths, output_path)
+        return
+    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_STORED) as zf:
+        for n, page_path in enumerate(page_paths, 1):
+            zf.write(page_path, f"contact_sheet_p{n:03d}.jpg")
+
+
+def process_contact_sheet_task(task_id, input_path, original_filename, options):
+    label = 'Generating contact sheet...'
     try:
-        update_task_status(task_id, 'processing', progress='Generating contact sheet...')
+        update_task_status(task_id, 'processing', progress=label)
 
-        output_filename = f"contact_sheet_{task_id}.jpg"
-        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+        output_path = os.path.join(OUTPUT_FOLDER, f"contact_sheet_{task_id}.jpg")
+        interval, width, cols = options['interval'], options['width'], options['cols']
 
         duration = get_video_duration(input_path)
-        num_frames = int(duration / interval) + 1
-        rows = math.ceil(num_frames / cols)
-
-        create_contact_sheet(input_path, interval, width, cols, output_path)
+        mode = options.get('mode') or 'interval'
+        scenes = None
+        if mode == 'scene':
+            scenes = scene_timestamps(input_path, options.get('target_tiles'),
+                                      ffmpeg_progress_reporter(task_id, 'Detecting scenes...'))
+            if not scenes:
+                # Nothing was sampled to compare; fall back to a frame every interval
+                mode, scenes = 'interval', None
+        if scenes:
+            interval = None
+        else:
+            # Validates the tile limit before any work; the sheet itself
+            # samples the same timestamps
+            _, interval = contact_sheet_timestamps(duration, interval, options.get('target_tiles'))
+
+        # Finished pages are published right away, before the whole sheet is done
+        partial = {'pages': []}
+
+        def page_done(page_path, number, count):
+            partial['pages'].append(os.path.basename(page_path))
+            update_task_status(task_id, 'processing', progress=f"{label} ({number}/{count})",
+                               result=partial)
+
+        page_paths, frame_count = create_contact_sheet(
+            input_path, interval, width, cols, output_path,
+            ffmpeg_progress_reporter(task_id, label, partial),
+            options.get('extract'), options.get('target_tiles'), page_done, scenes
+        )
 
         if os.path.exists(input_path):
             os.remove(input_path)
 
-        update_task_status(task_id, 'completed', result={
-            'filename': output_filename,
+        if len(page_paths) > 1:
+            output_format = options.get('output_format') or 'zip'
+            output_path = os.path.join(OUTPUT_FOLDER, f"contact_sheet_{task_id}.{output_format}")
+            package_contact_sheet(page_paths, output_path, output_format)
+        else:
+            output_path = page_paths[0]
+
+        result = {
+            'filename': os.path.basename(output_path),
+            'pages': [os.path.basename(path) for path in page_paths],
             'original_name': original_filename,
             'duration': round(duration, 2),
-            'frames': num_frames,
-            'grid': f'{cols}x{rows}',
+            'frames': frame_count,
+            'mode': mode,
+            'interval': round(interval, 2) if interval else None,
+            'grid': f'{cols}x{math.ceil(frame_count / cols)}',
             'type': 'contact_sheet'
-        })
+        }
+        if options.get('cache_key'):
+            result_cache_put(options['cache_key'], 'contactsheet', result)
+        update_task_status(task_id, 'completed', result=result)
 
     except Exception as e:
         update_task_status(task_id, 'failed', error=str(e))
@@ -458,6 +2138,781 @@ def process_contact_sheet_task(task_id, input_path, interval, width, cols, origi
             os.remove(input_path)
 
 
+def parse_contact_sheet_options(ext, params):
+    if ext not in VIDEO_EXTS:
+        raise ValueError(f'Only video files are supported. Got: {ext}')
+
+    try:
+        interval = float(params.get('interval', 3))
+        width = int(params.get('width', 320))
+        cols = int(params.get('cols', 5))
+    except (TypeError, ValueError):
+        raise ValueError('interval, width and cols must be numbers')
+    if interval <= 0 or width <= 0 or cols <= 0:
+        raise ValueError('interval, width and cols must be positive')
+
+    if width * cols > JPEG_MAX_DIMENSION:
+        raise ValueError(f'width x cols must not exceed {JPEG_MAX_DIMENSION} pixels')
+
+    mode = params.get('mode') or 'interval'
+    if mode not in CONTACT_SHEET_MODES:
+        raise ValueError(f'mode must be one of: {", ".join(CONTACT_SHEET_MODES)}')
+
+    extract = params.get('extract') or CONTACT_SHEET_EXTRACT
+    if extract not in CONTACT_SHEET_EXTRACT_MODES:
+        raise ValueError(f'extract must be one of: {", ".join(CONTACT_SHEET_EXTRACT_MODES)}')
+
+    try:
+        target_tiles = int(params.get('target_tiles') or 0) or None
+    except (TypeError, ValueError):
+        raise ValueError('target_tiles must be a number')
+    if target_tiles is not None and not 0 < target_tiles <= CONTACT_SHEET_MAX_TILES:
+        raise ValueError(f'target_tiles must be between 1 and {CONTACT_SHEET_MAX_TILES}')
+
+    output_format = params.get('output_format') or 'zip'
+    if output_format not in CONTACT_SHEET_FORMATS:
+        raise ValueError(f'output_format must be one of: {", ".join(CONTACT_SHEET_FORMATS)}')
+
+    return {'pool': 'ffmpeg', 'mode': mode, 'interval': interval, 'width': width, 'cols': cols,
+            'extract': extract, 'target_tiles': target_tiles, 'output_format': output_format}
+
+
+def submit_contact_sheet_job(task_id, input_path, ext, original_filename, options):
+    return submit_job(options['pool'], task_id, process_contact_sheet_task,
+                      input_path, original_filename, options)
+
+
+# ═══════════════════════════════════════════════════════════════
+#  CHUNKED UPLOADS (resumable, written straight to UPLOAD_FOLDER)
+# ═══════════════════════════════════════════════════════════════
+# init -> PUT chunks at explicit offsets -> complete. Session metadata is a
+# small JSON file next to the data, so any gunicorn worker can serve any
+# chunk, and the current offset is simply the size of the data file.
+CHUNKED_UPLOAD_MAX_BYTES = int(os.getenv('CHUNKED_UPLOAD_MAX_BYTES', 4 * 1024 * 1024 * 1024))
+CHUNKED_UPLOAD_TTL = int(os.getenv('CHUNKED_UPLOAD_TTL', 24 * 3600))
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
+UPLOAD_TOOLS = {
+    'watermark': (parse_watermark_options, submit_watermark_job),
+    'contactsheet': (parse_contact_sheet_options, submit_contact_sheet_job),
+}
+
+# Running SHA-256 of each upload as (offset, hasher), fed while chunks are
+# written. A chunk served by another worker breaks the chain; complete then
+# falls back to hashing the file.
+_UPLOAD_HASHERS = {}
+_UPLOAD_HASHERS_LOCK = threading.Lock()
+
+
+def upload_session_path(upload_id):
+    return os.path.join(UPLOAD_FOLDER, f"{upload_id}.upload.json")
+
+
+def load_upload_session(upload_id):
+    if not UPLOAD_ID_RE.match(upload_id):
+        return None
+    try:
+        with open(upload_session_path(upload_id)) as f:
+            session = json.load(f)
+    except (OSError, ValueError):
+        return None
+    session['data_path'] = os.path.join(UPLOAD_FOLDER, f"{upload_id}{session['ext']}")
+    return session
+
+
+def save_upload(file, path):
+    # Copies a multipart upload to disk, hashing each block on the way
+    hasher = hashlib.sha256()
+    with open(path, 'wb') as dst:
+        for block in iter(lambda: file.stream.read(UPLOAD_BLOCK_SIZE), b''):
+            hasher.update(block)
+            dst.write(block)
+    return hasher.hexdigest()
+
+
+def upload_sha256(upload_id, data_path):
+    with _UPLOAD_HASHERS_LOCK:
+        running = _UPLOAD_HASHERS.pop(upload_id, None)
+    if running and running[0] == os.path.getsize(data_path):
+        return running[1].hexdigest()
+    return file_sha256(data_path)
+
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(UPLOAD_BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def cleanup_stale_uploads():
+    cutoff = time.time() - CHUNKED_UPLOAD_TTL
+    for entry in os.scandir(UPLOAD_FOLDER):
+        if not entry.name.endswith('.upload.json') or entry.stat().st_mtime >= cutoff:
+            continue
+        upload_id = entry.name[:-len('.upload.json')]
+        session = load_upload_session(upload_id)
+        if session and os.path.exists(session['data_path']):
+            os.remove(session['data_path'])
+        os.remove(entry.path)
+        with _UPLOAD_HASHERS_LOCK:
+            _UPLOAD_HASHERS.pop(upload_id, None)
+
+
+# ═══════════════════════════════════════════════════════════════
+#  RESULT CACHE (content-addressed, deduplicates identical jobs)
+# ═══════════════════════════════════════════════════════════════
+# Keyed by (input SHA-256, tool, parameters). Entries point at files in
+# OUTPUT_FOLDER and are evicted least-recently-used once their total size
+# passes RESULT_CACHE_MAX_BYTES (0 disables the cache); eviction forgets the
+# entry and leaves the files to the disk sweeper. Bump RESULT_CACHE_VERSION
+# when processing output changes.
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+RESULT_CACHE_VERSION = 2
+
+_result_cache_ready = False
+
+
+def result_cache_db():
+    global _result_cache_ready
+    conn = get_db()
+    if not _result_cache_ready:
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS result_cache (
+                cache_key TEXT PRIMARY KEY,
+                tool TEXT NOT NULL,
+                result TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS result_cache_last_used ON result_cache (last_used);
+            CREATE TABLE IF NOT EXISTS cache_stats (
+                name TEXT PRIMARY KEY,
+                hits INTEGER NOT NULL DEFAULT 0,
+                misses INTEGER NOT NULL DEFAULT 0
+            );
+        ''')
+        _result_cache_ready = True
+    return conn
+
+
+def count_cache_lookup(name, hit):
+    column = 'hits' if hit else 'misses'
+    result_cache_db().execute(
+        f'INSERT INTO cache_stats (name, {column}) VALUES (?, 1) '
+        f'ON CONFLICT (name) DO UPDATE SET {column} = {column} + 1',
+        (name,)
+    )
+
+
+def result_files(result):
+    files = [result[key] for key in ('filename', 'preview_filename') if result.get(key)]
+    return files + [page for page in result.get('pages', []) if page not in files]
+
+
+def result_cache_key(input_hash, tool, ext, options):
+    params = {k: v for k, v in options.items() if k not in ('pool', 'cache_key')}
+    if tool == 'watermark':
+        params['watermark'] = [WATERMARK_TEXT, OPACITY, os.path.basename(FONT_PATH),
+                               LETTER_SPACING, TARGET_WIDTH_RATIO]
+    payload = json.dumps([RESULT_CACHE_VERSION, input_hash, tool, ext, params], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def result_cache_get(cache_key):
+    if RESULT_CACHE_MAX_BYTES <= 0:
+        return None
+    conn = result_cache_db()
+    row = conn.execute('SELECT result FROM result_cache WHERE cache_key = ?', (cache_key,)).fetchone()
+    result = json.loads(row[0]) if row else None
+
+    # Output files can disappear underneath the cache; treat that as a miss
+    if result and not all(os.path.exists(os.path.join(OUTPUT_FOLDER, f)) for f in result_files(result)):
+        conn.execute('DELETE FROM result_cache WHERE cache_key = ?', (cache_key,))
+        result = None
+
+    if result:
+        conn.execute('UPDATE result_cache SET last_used = ? WHERE cache_key = ?', (time.time(), cache_key))
+    count_cache_lookup('result', result is not None)
+    return result
+
+
+def result_cache_put(cache_key, tool, result):
+    if RESULT_CACHE_MAX_BYTES <= 0:
+        return
+    size = sum(os.path.getsize(os.path.join(OUTPUT_FOLDER, f)) for f in result_files(result))
+    conn = result_cache_db()
+    conn.execute(
+        'INSERT OR REPLACE INTO result_cache (cache_key, tool, result, size, last_used) VALUES (?, ?, ?, ?, ?)',
+        (cache_key, tool, json.dumps(result), size, time.time())
+    )
+
+    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM result_cache').fetchone()[0]
+    if total <= RESULT_CACHE_MAX_BYTES:
+        return
+    # Only the rows go: the files may still back a live task, and their
+    # lifetime belongs to the disk sweeper (OUTPUT_TTL / OUTPUT_MAX_BYTES)
+    for key, old_size in conn.execute(
+        'SELECT cache_key, size FROM result_cache ORDER BY last_used'
+    ).fetchall():
+        if total <= RESULT_CACHE_MAX_BYTES or key == cache_key:
+            break
+        conn.execute('DELETE FROM result_cache WHERE cache_key = ?', (key,))
+        total -= old_size
+
+
+def cache_lookup_stats(name):
+    row = result_cache_db().execute('SELECT hits, misses FROM cache_stats WHERE name = ?', (name,)).fetchone()
+    hits, misses = row if row else (0, 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None
+    }
+
+
+def result_cache_stats():
+    entries, size = result_cache_db().execute(
+        'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM result_cache'
+    ).fetchone()
+    return {
+        'entries': entries,
+        'bytes': size,
+        'max_bytes': RESULT_CACHE_MAX_BYTES,
+        **cache_lookup_stats('result')
+    }
+
+
+def start_tool_job(tool, task_id, input_path, ext, original_filename, options, input_hash):
+    # An identical earlier job completes the task immediately; otherwise the
+    # job is queued and stores its result under the same key when it finishes.
+    options['cache_key'] = result_cache_key(input_hash, tool, ext, options)
+    cached = result_cache_get(options['cache_key'])
+    if cached:
+        os.remove(input_path)
+        update_task_status(task_id, 'completed', result={
+            **cached, 'original_name': original_filename, 'cached': True
+        })
+        return True
+    return UPLOAD_TOOLS[tool][1](task_id, input_path, ext, original_filename, options)
+
+
+# ═══════════════════════════════════════════════════════════════
+#  DISK LIFECYCLE (output retention, quota and orphan sweep)
+# ═══════════════════════════════════════════════════════════════
+# Every file a task delivers is recorded in the artifacts table; previews and
+# downloads refresh its last_access. A background thread per worker runs a
+# sweep every DISK_SWEEP_INTERVAL, and a non-blocking flock lets only one
+# worker sweep at a time. A sweep removes artifacts idle for OUTPUT_TTL,
+# then the least recently used ones until OUTPUT_MAX_BYTES is met, then
+# untracked files (crashed tasks, stray temp audio) older than ORPHAN_MIN_AGE.
+OUTPUT_TTL = int(os.getenv('OUTPUT_TTL', 24 * 3600))
+OUTPUT_MAX_BYTES = int(os.getenv('OUTPUT_MAX_BYTES', 10 * 1024 * 1024 * 1024))
+ORPHAN_MIN_AGE = int(os.getenv('ORPHAN_MIN_AGE', 6 * 3600))
+DISK_SWEEP_INTERVAL = int(os.getenv('DISK_SWEEP_INTERVAL', 300))
+DISK_SWEEP_LOCK_PATH = f"{DB_PATH}.sweep.lock"
+
+_artifacts_ready = False
+_disk_manager_pid = None
+_disk_manager_lock = threading.Lock()
+
+
+def artifacts_db():
+    global _artifacts_ready
+    conn = get_db()
+    if not _artifacts_ready:
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS artifacts (
+                name TEXT PRIMARY KEY,
+                task_id TEXT,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                etag TEXT
+            );
+            CREATE INDEX IF NOT EXISTS artifacts_last_access ON artifacts (last_access);
+            CREATE TABLE IF NOT EXISTS disk_sweeps (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                data TEXT NOT NULL
+            );
+        ''')
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(artifacts)')]
+        if 'etag' not in columns:
+            conn.execute('ALTER TABLE artifacts ADD COLUMN etag TEXT')
+        _artifacts_ready = True
+    return conn
+
+
+def track_artifacts(task_id, result):
+    # Outputs never change once written, so the content hash taken here (off
+    # the request path, while the file is still in the page cache) serves as
+    # a strong ETag for every later download
+    now = time.time()
+    conn = artifacts_db()
+    for name in result_files(result):
+        path = os.path.join(OUTPUT_FOLDER, name)
+        if not os.path.exists(path):
+            continue
+        updated = conn.execute('UPDATE artifacts SET last_access = ? WHERE name = ?', (now, name)).rowcount
+        if not updated:
+            conn.execute(
+                'INSERT OR IGNORE INTO artifacts (name, task_id, size, created_at, last_access, etag) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (name, task_id, os.path.getsize(path), now, now, file_sha256(path))
+            )
+
+
+def touch_artifact(name):
+    # Returns the stored ETag (None for untracked files)
+    conn = artifacts_db()
+    conn.execute('UPDATE artifacts SET last_access = ? WHERE name = ?', (time.time(), name))
+    row = conn.execute('SELECT etag FROM artifacts WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+
+def remove_artifact(conn, name):
+    path = os.path.join(OUTPUT_FOLDER, name)
+    if os.path.exists(path):
+        os.remove(path)
+    conn.execute('DELETE FROM artifacts WHERE name = ?', (name,))
+
+
+def sweep_artifacts(now):
+    conn = artifacts_db()
+    expired = conn.execute(
+        'SELECT name, size FROM artifacts WHERE last_access < ?', (now - OUTPUT_TTL,)
+    ).fetchall()
+    for name, _ in expired:
+        remove_artifact(conn, name)
+
+    evicted = []
+    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM artifacts').fetchone()[0]
+    if total > OUTPUT_MAX_BYTES:
+        for name, size in conn.execute('SELECT name, size FROM artifacts ORDER BY last_access').fetchall():
+            if total <= OUTPUT_MAX_BYTES:
+                break
+            remove_artifact(conn, name)
+            evicted.append((name, size))
+            total -= size
+
+    return {
+        'expired': len(expired),
+        'evicted': len(evicted),
+        'freed_bytes': sum(size for _, size in expired + evicted),
+    }
+
+
+def sweep_orphans(now):
+    cutoff = now - ORPHAN_MIN_AGE
+    tracked = {name for (name,) in artifacts_db().execute('SELECT name FROM artifacts')}
+    removed = 0
+    freed = 0
+
+    for entry in os.scandir(OUTPUT_FOLDER):
+        if entry.is_file() and entry.name not in tracked and entry.stat().st_mtime < cutoff:
+            freed += entry.stat().st_size
+            os.remove(entry.path)
+            removed += 1
+
+    for entry in os.scandir(UPLOAD_FOLDER):
+        # Resumable uploads have their own TTL (cleanup_stale_uploads)
+        upload_id = entry.name.split('.', 1)[0]
+        if os.path.exists(upload_session_path(upload_id)) or entry.stat().st_mtime >= cutoff:
+            continue
+        if entry.is_dir():
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            freed += entry.stat().st_size
+            os.remove(entry.path)
+        removed += 1
+
+    return {'orphans': removed, 'orphan_bytes': freed}
+
+
+def run_disk_sweep():
+    # Returns the sweep stats, or None when another worker holds the lease
+    with open(DISK_SWEEP_LOCK_PATH, 'a') as lease:
+        try:
+            fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        now = time.time()
+        stats = {**sweep_artifacts(now), **sweep_orphans(now), 'finished_at': time.time()}
+        artifacts_db().execute('INSERT OR REPLACE INTO disk_sweeps (id, data) VALUES (1, ?)',
+                               (json.dumps(stats),))
+        return stats
+
+
+def disk_manager_loop():
+    # The first pass runs right away, so a restarted container starts by
+    # clearing whatever the previous one left behind
+    while True:
+        try:
+            run_disk_sweep()
+        except Exception as e:
+            print(f"Disk sweep failed: {e}")
+        time.sleep(DISK_SWEEP_INTERVAL)
+
+
+def start_disk_manager():
+    # Once per worker process (threads do not survive a fork)
+    global _disk_manager_pid
+    if DISK_SWEEP_INTERVAL <= 0 or _disk_manager_pid == os.getpid():
+        return
+    with _disk_manager_lock:
+        if _disk_manager_pid == os.getpid():
+            return
+        _disk_manager_pid = os.getpid()
+        threading.Thread(target=disk_manager_loop, daemon=True).start()
+
+
+def folder_usage(folder):
+    files = 0
+    size = 0
+    for root, _, names in os.walk(folder):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+                files += 1
+            except OSError:
+                pass
+    return {'files': files, 'bytes': size}
+
+
+def disk_usage_stats():
+    conn = artifacts_db()
+    files, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts').fetchone()
+    row = conn.execute('SELECT data FROM disk_sweeps WHERE id = 1').fetchone()
+    disk = shutil.disk_usage(OUTPUT_FOLDER)
+    return {
+        'output': {
+            'tracked_files': files,
+            'tracked_bytes': size,
+            'max_bytes': OUTPUT_MAX_BYTES,
+            'ttl': OUTPUT_TTL,
+            **folder_usage(OUTPUT_FOLDER)
+        },
+        'uploads': folder_usage(UPLOAD_FOLDER),
+        'disk': {'total': disk.total, 'used': disk.used, 'free': disk.free},
+        'last_sweep': json.loads(row[0]) if row else None
+    }
+
+
+# ═══════════════════════════════════════════════════════════════
+#  FILE DELIVERY
+# ═══════════════════════════════════════════════════════════════
+# FILE_DELIVERY=flask streams outputs from the worker with Range (206),
+# ETag/Last-Modified and 304 handling. Behind a web server the transfer
+# can be handed off: x-sendfile (Apache/lighttpd) or x-accel (nginx, with an
+# internal location mapping X_ACCEL_PREFIX to the output folder).
+FILE_DELIVERY = os.getenv('FILE_DELIVERY', 'flask')
+X_ACCEL_PREFIX = os.getenv('X_ACCEL_PREFIX', '/protected-output').rstrip('/')
+OUTPUT_CACHE_MAX_AGE = 3600
+
+app.use_x_sendfile = FILE_DELIVERY == 'x-sendfile'
+
+
+def output_file_path(filename):
+    # None for names that escape OUTPUT_FOLDER or do not exist
+    path = safe_join(OUTPUT_FOLDER, filename)
+    return path if path and os.path.isfile(path) else None
+
+
+def send_output(filename, file_path, **kwargs):
+    etag = touch_artifact(filename)
+    if FILE_DELIVERY != 'x-accel':
+        return send_file(file_path, etag=etag or True, conditional=True,
+                         max_age=OUTPUT_CACHE_MAX_AGE, **kwargs)
+
+    response = Response(mimetype=kwargs.get('mimetype') or mimetypes.guess_type(filename)[0]
+                        or 'application/octet-stream')
+    if etag:
+        response.set_etag(etag)
+    response.last_modified = os.path.getmtime(file_path)
+    response.cache_control.max_age = OUTPUT_CACHE_MAX_AGE
+    response.make_conditional(request)
+    if response.status_code != 304:
+        # nginx serves the body (and Range requests) itself
+        response.headers['X-Accel-Redirect'] = f"{X_ACCEL_PREFIX}/{quote(filename)}"
+    return response
+
+
+# ═══════════════════════════════════════════════════════════════
+#  METRICS (Prometheus text format, shared across workers)
+# ═══════════════════════════════════════════════════════════════
+# Each process keeps its histograms in memory and a background thread
+# writes their running totals to SQLite every METRICS_FLUSH_INTERVAL, one
+# row set per process. /metrics sums the rows of every process (totals of
+# exited workers stay in, so counters never go backwards); gauges only
+# count processes that flushed recently.
+METRICS_FLUSH_INTERVAL = int(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+METRICS_HELP = {
+    'upload_seconds': 'Time to receive and store an upload request body',
+    'job_queue_seconds': 'Time a job waited in its pool queue',
+    'job_run_seconds': 'Time a job spent processing',
+    'job_total_seconds': 'Time from job submission to completion',
+    'step_seconds': 'Time spent in subprocess and network calls',
+}
+
+_metrics_ready = False
+_metrics = {}
+_metrics_lock = threading.Lock()
+_metrics_process = None  # (pid, process id written to SQLite)
+
+
+def metrics_db():
+    global _metrics_ready
+    conn = get_db()
+    if not _metrics_ready:
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS metric_histograms (
+                process TEXT NOT NULL,
+                name TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                buckets TEXT NOT NULL,
+                sum REAL NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (process, name, labels)
+            );
+            CREATE TABLE IF NOT EXISTS metric_gauges (
+                process TEXT NOT NULL,
+                name TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                value REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (process, name, labels)
+            );
+        ''')
+        _metrics_ready = True
+    return conn
+
+
+def observe(name, seconds, **labels):
+    start_metrics_flusher()
+    key = (name, json.dumps(labels, sort_keys=True))
+    with _metrics_lock:
+        hist = _metrics.get(key)
+        if hist is None:
+            hist = _metrics[key] = {'buckets': [0] * len(METRICS_BUCKETS), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                hist['buckets'][i] += 1
+        hist['sum'] += seconds
+        hist['count'] += 1
+
+
+@contextmanager
+def timed(step):
+    started = time.time()
+    try:
+        yield
+    finally:
+        observe('step_seconds', time.time() - started, step=step)
+
+
+def flush_metrics():
+    start_metrics_flusher()
+    process = _metrics_process[1]
+    with _metrics_lock:
+        histograms = [(process, name, labels, json.dumps(hist['buckets']), hist['sum'], hist['count'])
+                      for (name, labels), hist in _metrics.items()]
+    with JOBS_LOCK:
+        now = time.time()
+        gauges = [(process, name, json.dumps({'pool': pool}), value, now)
+                  for pool in JOB_POOLS
+                  for name, value in (('jobs_running', JOB_RUNNING[pool]),
+                                      ('jobs_queued', len(JOB_QUEUES[pool])))]
+    conn = metrics_db()
+    conn.executemany('INSERT OR REPLACE INTO metric_histograms VALUES (?, ?, ?, ?, ?, ?)', histograms)
+    conn.executemany('INSERT OR REPLACE INTO metric_gauges VALUES (?, ?, ?, ?, ?)', gauges)
+
+
+def metrics_flusher_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush_metrics()
+        except Exception as e:
+            print(f"Metrics flush failed: {e}")
+
+
+def start_metrics_flusher():
+    # Once per worker process; a forked child starts over with empty
+    # histograms under a new process id
+    global _metrics_process
+    if _metrics_process and _metrics_process[0] == os.getpid():
+        return
+    with _metrics_lock:
+        if _metrics_process and _metrics_process[0] == os.getpid():
+            return
+        _metrics.clear()
+        _metrics_process = (os.getpid(), uuid.uuid4().hex)
+        threading.Thread(target=metrics_flusher_loop, daemon=True).start()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = {k: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for k, v in labels.items()}
+    return '{' + ','.join(f'{k}="{v}"' for k, v in sorted(escaped.items())) + '}'
+
+
+def render_metrics():
+    flush_metrics()
+    conn = metrics_db()
+    lines = []
+
+    histograms = {}
+    for name, labels, buckets, total, count in conn.execute(
+        'SELECT name, labels, buckets, sum, count FROM metric_histograms ORDER BY name, labels'
+    ):
+        hist = histograms.setdefault(name, {}).setdefault(
+            labels, {'buckets': [0] * len(METRICS_BUCKETS), 'sum': 0.0, 'count': 0})
+        for i, value in enumerate(json.loads(buckets)[:len(METRICS_BUCKETS)]):
+            hist['buckets'][i] += value
+        hist['sum'] += total
+        hist['count'] += count
+    for name, series in histograms.items():
+        metric = f'toolkit_{name}'
+        lines.append(f'# HELP {metric} {METRICS_HELP.get(name, name)}')
+        lines.append(f'# TYPE {metric} histogram')
+        for labels, hist in series.items():
+            labels = json.loads(labels)
+            for bound, value in zip(METRICS_BUCKETS, hist['buckets']):
+                lines.append(f'{metric}_bucket{format_labels({**labels, "le": float(bound)})} {value}')
+            lines.append(f'{metric}_bucket{format_labels({**labels, "le": "+Inf"})} {hist["count"]}')
+            lines.append(f'{metric}_sum{format_labels(labels)} {hist["sum"]:.6f}')
+            lines.append(f'{metric}_count{format_labels(labels)} {hist["count"]}')
+
+    gauges = {}
+    for name, labels, value in conn.execute(
+        'SELECT name, labels, SUM(value) FROM metric_gauges WHERE updated_at > ? '
+        'GROUP BY name, labels ORDER BY name, labels',
+        (time.time() - 3 * METRICS_FLUSH_INTERVAL,)
+    ):
+        gauges.setdefault(name, []).append((json.loads(labels), value))
+    for name, help_text in (('jobs_running', 'Jobs currently processing, all workers'),
+                            ('jobs_queued', 'Jobs waiting in pool queues, all workers')):
+        lines.append(f'# HELP toolkit_{name} {help_text}')
+        lines.append(f'# TYPE toolkit_{name} gauge')
+        for labels, value in gauges.get(name, []):
+            lines.append(f'toolkit_{name}{format_labels(labels)} {value:g}')
+
+    caches = result_cache_db().execute('SELECT name, hits, misses FROM cache_stats ORDER BY name').fetchall()
+    for index, (metric, help_text, kind) in enumerate((
+        ('cache_hits_total', 'Cache lookups that found an entry', 'counter'),
+        ('cache_misses_total', 'Cache lookups that found nothing', 'counter'),
+        ('cache_hit_ratio', 'Share of cache lookups that hit', 'gauge'),
+    )):
+        lines.append(f'# HELP toolkit_{metric} {help_text}')
+        lines.append(f'# TYPE toolkit_{metric} {kind}')
+        for cache, hits, misses in caches:
+            value = (hits, misses, hits / (hits + misses) if hits + misses else 0)[index]
+            lines.append(f'toolkit_{metric}{format_labels({"cache": cache})} {value:g}')
+
+    files, size = artifacts_db().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts').fetchone()
+    lines += [
+        '# HELP toolkit_output_bytes Size of tracked output files',
+        '# TYPE toolkit_output_bytes gauge',
+        f'toolkit_output_bytes {size}',
+        '# HELP toolkit_output_files Number of tracked output files',
+        '# TYPE toolkit_output_files gauge',
+        f'toolkit_output_files {files}',
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+# ═══════════════════════════════════════════════════════════════
+#  STARTUP (warm-up and readiness)
+# ═══════════════════════════════════════════════════════════════
+# warm_up() pays the one-off costs before the first request: fonts and
+# glyph metrics, ffmpeg/ffprobe checks and the SDK imports of the YouTube
+# tool. gunicorn.conf.py runs it in the master when preloading (workers
+# inherit the result through fork), otherwise in each worker; elsewhere
+# /healthz starts it in the background. It starts no threads, so the
+# master stays safe to fork. WARMUP=0 skips it.
+WARMUP = os.getenv('WARMUP', '1') == '1'
+WARMUP_MODULES = [name for name in os.getenv(
+    'WARMUP_MODULES',
+    'numpy,yt_dlp,youtube_transcript_api,youtube_transcript_api.formatters,google.generativeai'
+).split(',') if name]
+WARMUP_WIDTHS = (720, 1080, 1280, 1920, 2160, 3840)
+REQUIRED_BINARIES = ('ffmpeg', 'ffprobe')
+
+_warmup = {'state': 'pending' if WARMUP else 'skipped', 'checks': {}}
+_warmup_lock = threading.Lock()
+
+
+def check_binary(name):
+    try:
+        result = subprocess.run([name, '-version'], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        return {'ok': False, 'error': str(e)}
+    if result.returncode != 0:
+        return {'ok': False, 'error': result.stderr.strip()[-200:]}
+    return {'ok': True, 'version': result.stdout.split('\n')[0]}
+
+
+def warm_up():
+    with _warmup_lock:
+        if _warmup['state'] != 'pending':
+            return _warmup
+        _warmup['state'] = 'running'
+    started = time.time()
+    checks = {}
+
+    for name in REQUIRED_BINARIES:
+        checks[name] = check_binary(name)
+
+    try:
+        for width in WARMUP_WIDTHS:
+            get_glyph_widths(WATERMARK_TEXT, get_optimal_font_size(width))
+        checks['font'] = {'ok': True}
+    except OSError as e:
+        checks['font'] = {'ok': False, 'error': str(e)}
+
+    for module in WARMUP_MODULES:
+        module_started = time.time()
+        try:
+            importlib.import_module(module)
+            checks[module] = {'ok': True, 'seconds': round(time.time() - module_started, 3)}
+        except Exception as e:
+            checks[module] = {'ok': False, 'error': str(e)}
+
+    _warmup.update({
+        'state': 'ready',
+        'checks': checks,
+        'seconds': round(time.time() - started, 3),
+        'finished_at': time.time(),
+    })
+    return _warmup
+
+
+def start_warm_up():
+    if _warmup['state'] == 'pending':
+        threading.Thread(target=warm_up, daemon=True).start()
+
+
+def readiness():
+    # Ready once warm-up has finished (or is disabled) and the binaries
+    # every video tool needs are present
+    missing = [name for name in REQUIRED_BINARIES
+               if not _warmup['checks'].get(name, {'ok': True})['ok']]
+    ready = _warmup['state'] in ('ready', 'skipped') and not missing
+    return ready, {
+        'status': 'ok' if ready else ('unavailable' if missing else 'starting'),
+        'warmup': _warmup['state'],
+        'warmup_seconds': _warmup.get('seconds'),
+        'missing': missing,
+        'checks': _warmup['checks'],
+        'pid': os.getpid(),
+    }
+
+
 # ═══════════════════════════════════════════════════════════════
 #  ROUTES
 # ═══════════════════════════════════════════════════════════════
@@ -470,6 +2925,7 @@ def index():
 @app.route('/api/watermark/upload', methods=['POST'])
 def watermark_upload():
     cleanup_old_tasks()
+    upload_started = time.time()
 
     if 'file' not in request.files:
         return jsonify({'error': 'No file uploaded'}), 400
@@ -479,26 +2935,73 @@ def watermark_upload():
         return jsonify({'error': 'No file selected'}), 400
 
     ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in IMAGE_EXTS and ext not in VIDEO_EXTS:
-        return jsonify({'error': f'Unsupported file format: {ext}'}), 400
+    try:
+        options = parse_watermark_options(ext, request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if job_queue_full(options['pool']):
+        return queue_full_response(options['pool'])
 
     task_id = uuid.uuid4().hex
     input_filename = f"{task_id}{ext}"
     input_path = os.path.join(UPLOAD_FOLDER, input_filename)
-    file.save(input_path)
+    input_hash = save_upload(file, input_path)
+    observe('upload_seconds', time.time() - upload_started, route='watermark')
 
-    output_filename = f"watermarked_{task_id}{ext}"
-    output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+    if not start_tool_job('watermark', task_id, input_path, ext, file.filename, options, input_hash):
+        os.remove(input_path)
+        return queue_full_response(options['pool'])
 
-    update_task_status(task_id, 'queued')
+    return jsonify({'success': True, 'task_id': task_id})
 
-    thread = threading.Thread(
-        target=process_watermark_task,
-        args=(task_id, input_path, output_path, ext, file.filename)
-    )
-    thread.start()
 
-    return jsonify({'success': True, 'task_id': task_id})
+@app.route('/api/watermark/batch', methods=['POST'])
+def watermark_batch():
+    cleanup_old_tasks()
+    upload_started = time.time()
+
+    files = [f for f in request.files.getlist('files') + request.files.getlist('file')
+             if f.filename]
+    if not files:
+        return jsonify({'error': 'No files uploaded'}), 400
+
+    if job_queue_full('image'):
+        return queue_full_response('image')
+
+    task_id = uuid.uuid4().hex
+    batch_dir = os.path.join(UPLOAD_FOLDER, f"batch_{task_id}")
+    os.makedirs(batch_dir)
+
+    items = []
+    try:
+        for file in files:
+            ext = os.path.splitext(file.filename)[1].lower()
+            if ext == '.zip':
+                zip_path = os.path.join(batch_dir, f"upload_{uuid.uuid4().hex}.zip")
+                file.save(zip_path)
+                items.extend(extract_batch_zip(zip_path, batch_dir, len(items)))
+                os.remove(zip_path)
+            elif ext in IMAGE_EXTS:
+                input_path = os.path.join(batch_dir, f"{len(items):05d}{ext}")
+                file.save(input_path)
+                items.append((input_path, os.path.basename(file.filename)))
+            if len(items) > BATCH_MAX_FILES:
+                raise ValueError(f'A batch can hold at most {BATCH_MAX_FILES} images')
+    except (ValueError, zipfile.BadZipFile) as e:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return jsonify({'error': str(e)}), 400
+
+    if not items:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return jsonify({'error': 'No supported images found'}), 400
+    observe('upload_seconds', time.time() - upload_started, route='batch')
+
+    if not submit_job('image', task_id, process_watermark_batch_task, batch_dir, items):
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return queue_full_response('image')
+
+    return jsonify({'success': True, 'task_id': task_id, 'total': len(items)})
 
 
 # --- YOUTUBE SUMMARIZER ROUTES ---
@@ -520,13 +3023,14 @@ def youtube_summarize():
         return jsonify({'error': 'Gemini API Key is required'}), 400
 
     task_id = uuid.uuid4().hex
-    update_task_status(task_id, 'queued')
+    cached = youtube_cached_result(video_url, custom_prompt)
+    if cached:
+        update_task_status(task_id, 'completed', result=cached)
+        return jsonify({'success': True, 'task_id': task_id})
 
-    thread = threading.Thread(
-        target=process_youtube_task,
-        args=(task_id, video_url, api_key, custom_prompt)
-    )
-    thread.start()
+    if not submit_job('gemini', task_id, process_youtube_task,
+                      video_url, api_key, custom_prompt):
+        return queue_full_response('gemini')
 
     return jsonify({'success': True, 'task_id': task_id})
 
@@ -535,6 +3039,7 @@ def youtube_summarize():
 @app.route('/api/contactsheet/upload', methods=['POST'])
 def contactsheet_upload():
     cleanup_old_tasks()
+    upload_started = time.time()
 
     if 'file' not in request.files:
         return jsonify({'error': 'No file uploaded'}), 400
@@ -544,34 +3049,213 @@ def contactsheet_upload():
         return jsonify({'error': 'No file selected'}), 400
 
     ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in VIDEO_EXTS:
-        return jsonify({'error': f'Only video files are supported. Got: {ext}'}), 400
+    try:
+        options = parse_contact_sheet_options(ext, request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    interval = float(request.form.get('interval', 3))
-    width = int(request.form.get('width', 320))
-    cols = int(request.form.get('cols', 5))
+    if job_queue_full(options['pool']):
+        return queue_full_response(options['pool'])
 
     task_id = uuid.uuid4().hex
     input_filename = f"{task_id}{ext}"
     input_path = os.path.join(UPLOAD_FOLDER, input_filename)
-    file.save(input_path)
+    input_hash = save_upload(file, input_path)
+    observe('upload_seconds', time.time() - upload_started, route='contactsheet')
 
-    update_task_status(task_id, 'queued')
-
-    thread = threading.Thread(
-        target=process_contact_sheet_task,
-        args=(task_id, input_path, interval, width, cols, file.filename)
-    )
-    thread.start()
+    if not start_tool_job('contactsheet', task_id, input_path, ext, file.filename, options,
+                          input_hash):
+        os.remove(input_path)
+        return queue_full_response(options['pool'])
 
     return jsonify({'success': True, 'task_id': task_id})
 
 
+# --- CHUNKED UPLOAD ROUTES ---
+@app.route('/api/upload/init', methods=['POST'])
+def upload_init():
+    cleanup_old_tasks()
+
+    data = request.get_json(silent=True) or {}
+    filename = os.path.basename(str(data.get('filename', '')).strip())
+    ext = os.path.splitext(filename)[1].lower()
+    if not filename:
+        return jsonify({'error': 'filename is required'}), 400
+    if ext not in IMAGE_EXTS and ext not in VIDEO_EXTS:
+        return jsonify({'error': f'Unsupported file format: {ext}'}), 400
+
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'size is required'}), 400
+    if size <= 0 or size > CHUNKED_UPLOAD_MAX_BYTES:
+        return jsonify({'error': f'size must be between 1 and {CHUNKED_UPLOAD_MAX_BYTES} bytes'}), 400
+
+    upload_id = uuid.uuid4().hex
+    open(os.path.join(UPLOAD_FOLDER, f"{upload_id}{ext}"), 'wb').close()
+    with _UPLOAD_HASHERS_LOCK:
+        _UPLOAD_HASHERS[upload_id] = (0, hashlib.sha256())
+    with open(upload_session_path(upload_id), 'w') as f:
+        json.dump({'filename': filename, 'ext': ext, 'size': size, 'created': time.time()}, f)
+
+    return jsonify({'success': True, 'upload_id': upload_id, 'offset': 0,
+                    'chunk_size': 8 * 1024 * 1024})
+
+
+@app.route('/api/upload/<upload_id>', methods=['GET', 'HEAD'])
+def upload_offset(upload_id):
+    session = load_upload_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify({'offset': os.path.getsize(session['data_path']), 'size': session['size']})
+
+
+@app.route('/api/upload/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    upload_started = time.time()
+    session = load_upload_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.args.get('offset', '')))
+    except ValueError:
+        return jsonify({'error': 'Upload-Offset header is required'}), 400
+    expected_sha256 = (request.headers.get('X-Chunk-SHA256') or '').lower()
+
+    with open(session['data_path'], 'r+b') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return jsonify({'error': 'Another chunk is being written'}), 409
+
+        current = os.fstat(f.fileno()).st_size
+        if offset != current:
+            return jsonify({'error': 'Offset mismatch', 'offset': current}), 409
+
+        # request.stream is read block by block; the body never goes through
+        # Werkzeug's form parser or a temporary spool file.
+        with _UPLOAD_HASHERS_LOCK:
+            running = _UPLOAD_HASHERS.get(upload_id)
+        file_hasher = running[1].copy() if running and running[0] == offset else None
+
+        f.seek(offset)
+        hasher = hashlib.sha256()
+        written = 0
+        while True:
+            block = request.stream.read(UPLOAD_BLOCK_SIZE)
+            if not block:
+                break
+            written += len(block)
+            if offset + written > session['size']:
+                f.truncate(offset)
+                return jsonify({'error': 'Chunk exceeds the declared upload size', 'offset': offset}), 400
+            hasher.update(block)
+            if file_hasher:
+                file_hasher.update(block)
+            f.write(block)
+
+        if expected_sha256 and hasher.hexdigest() != expected_sha256:
+            f.truncate(offset)
+            return jsonify({'error': 'Chunk checksum mismatch', 'offset': offset}), 400
+
+        with _UPLOAD_HASHERS_LOCK:
+            if file_hasher:
+                _UPLOAD_HASHERS[upload_id] = (offset + written, file_hasher)
+            else:
+                _UPLOAD_HASHERS.pop(upload_id, None)
+
+    os.utime(upload_session_path(upload_id))
+    observe('upload_seconds', time.time() - upload_started, route='chunk')
+    return jsonify({'offset': offset + written, 'size': session['size']})
+
+
+@app.route('/api/upload/<upload_id>/complete', methods=['POST'])
+def upload_complete(upload_id):
+    session = load_upload_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    data = request.get_json(silent=True) or {}
+    tool = data.get('tool')
+    if tool not in UPLOAD_TOOLS:
+        return jsonify({'error': f'Unknown tool: {tool}'}), 400
+    parse_options = UPLOAD_TOOLS[tool][0]
+
+    offset = os.path.getsize(session['data_path'])
+    if offset != session['size']:
+        return jsonify({'error': 'Upload is incomplete', 'offset': offset}), 409
+
+    input_hash = upload_sha256(upload_id, session['data_path'])
+    if data.get('sha256') and input_hash != str(data['sha256']).lower():
+        return jsonify({'error': 'File checksum mismatch'}), 400
+
+    try:
+        options = parse_options(session['ext'], data.get('options') or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # The upload stays on disk when the queue is full, so the client only
+    # has to retry this call.
+    if job_queue_full(options['pool']):
+        return queue_full_response(options['pool'])
+
+    # Claiming the session file makes a repeated/concurrent complete a no-op
+    session_path = upload_session_path(upload_id)
+    claimed_path = f"{session_path}.claimed"
+    try:
+        os.rename(session_path, claimed_path)
+    except FileNotFoundError:
+        return jsonify({'error': 'Upload already completed'}), 409
+
+    if not start_tool_job(tool, upload_id, session['data_path'], session['ext'],
+                          session['filename'], options, input_hash):
+        os.rename(claimed_path, session_path)
+        return queue_full_response(options['pool'])
+
+    os.remove(claimed_path)
+    return jsonify({'success': True, 'task_id': upload_id})
+
+
+@app.route('/api/upload/<upload_id>', methods=['DELETE'])
+def upload_abort(upload_id):
+    session = load_upload_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    if os.path.exists(session['data_path']):
+        os.remove(session['data_path'])
+    os.remove(upload_session_path(upload_id))
+    with _UPLOAD_HASHERS_LOCK:
+        _UPLOAD_HASHERS.pop(upload_id, None)
+    return jsonify({'success': True})
+
+
+@app.route('/api/disk')
+def disk_stats():
+    return jsonify(disk_usage_stats())
+
+
+@app.route('/api/cache/stats')
+def cache_stats():
+    return jsonify({**result_cache_stats(), 'youtube_summary': cache_lookup_stats('youtube_summary')})
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/healthz')
+def healthz():
+    start_warm_up()
+    ready, status = readiness()
+    return jsonify(status), 200 if ready else 503
+
+
 # --- SHARED ROUTES ---
 @app.route('/api/status/<task_id>')
 def task_status(task_id):
-    with TASKS_LOCK:
-        task_info = TASKS.get(task_id)
+    task_info = get_task(task_id)
 
     if not task_info:
         return jsonify({'error': 'Task not found'}), 404
@@ -579,18 +3263,63 @@ def task_status(task_id):
     return jsonify(task_info)
 
 
+@app.route('/api/status/<task_id>/stream')
+def task_status_stream(task_id):
+    if get_task(task_id) is None:
+        return jsonify({'error': 'Task not found'}), 404
+
+    # Every open stream holds a worker thread; past the cap the client falls
+    # back to plain polling.
+    if _stream_clients >= TASK_STREAM_MAX_CLIENTS:
+        return jsonify({'error': 'Too many status streams'}), 503
+
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+    except ValueError:
+        since = 0
+
+    def generate():
+        global _stream_clients
+        version = since
+        deadline = time.time() + TASK_STREAM_MAX_AGE
+        with TASK_CHANGED:
+            _stream_clients += 1
+        try:
+            yield 'retry: 1000\n\n'
+            while time.time() < deadline:
+                task_info = wait_for_task_update(task_id, version, min(15, deadline - time.time()))
+                if task_info is None:
+                    yield 'event: gone\ndata: {}\n\n'
+                    return
+                if task_info['version'] <= version:
+                    yield ': keepalive\n\n'
+                    continue
+                version = task_info['version']
+                yield f"id: {version}\ndata: {json.dumps(task_info)}\n\n"
+                if task_info['status'] in ('completed', 'failed'):
+                    return
+        finally:
+            with TASK_CHANGED:
+                _stream_clients -= 1
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
 @app.route('/preview/<filename>')
 def preview(filename):
-    file_path = os.path.join(OUTPUT_FOLDER, filename)
-    if not os.path.exists(file_path):
+    file_path = output_file_path(filename)
+    if not file_path:
         return jsonify({'error': 'File not found'}), 404
-    return send_file(file_path)
+    return send_output(filename, file_path)
 
 
 @app.route('/download/<filename>')
 def download(filename):
-    file_path = os.path.join(OUTPUT_FOLDER, filename)
-    if not os.path.exists(file_path):
+    file_path = output_file_path(filename)
+    if not file_path:
         return jsonify({'error': 'File not found'}), 404
 
     # Get original name from query param, fallback to server filename
@@ -611,10 +3340,10 @@ def download(filename):
     encoded_name = quote(original_name)
 
     # Detect proper MIME type
-    import mimetypes
     mimetype = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
 
-    response = send_file(
+    response = send_output(
+        filename,
         file_path,
         mimetype=mimetype,
         as_attachment=True,
@@ -629,4 +3358,7 @@ def download(filename):
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
     debug = os.environ.get('FLASK_ENV', 'development') == 'development'
+    # Importing the app never deletes anything: the sweeper is started by
+    # the entry points that serve it (here and gunicorn.conf.py)
+    start_disk_manager()
     app.run(debug=debug, host='0.0.0.0', port=port)
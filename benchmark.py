@@ -0,0 +1,395 @@
+"""
+Local benchmarks for the OTSU Toolkit processing pipelines.
+
+    python benchmark.py watermark                 # images at 12/24/50 MP
+    python benchmark.py watermark --sizes 2,8 --video
+    python benchmark.py contactsheet --seconds 300
+    python benchmark.py suite --output results.json
+    python benchmark.py suite --baseline results.json   # exit 1 on regressions
+
+Every case runs in a forked child process so peak RSS is measured per case.
+Inputs are synthetic and generated locally, so runs are reproducible
+offline; the summarizer runs against a stub Gemini model.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from PIL import Image
+
+import app
+
+
+# ═══════════════════════════════════════════════════════════════
+#  MEASUREMENT
+# ═══════════════════════════════════════════════════════════════
+def _current_rss_kb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        return 0
+
+
+def _run_case(conn, fn, args):
+    start_rss = _current_rss_kb()
+    start_wall = time.perf_counter()
+    start_self = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    fn(*args)
+
+    wall = time.perf_counter() - start_wall
+    end_self = resource.getrusage(resource.RUSAGE_SELF)
+    end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (end_self.ru_utime - start_self.ru_utime + end_self.ru_stime - start_self.ru_stime
+           + end_children.ru_utime - start_children.ru_utime
+           + end_children.ru_stime - start_children.ru_stime)
+    conn.send({
+        'wall_s': round(wall, 4),
+        'cpu_s': round(cpu, 4),
+        # ru_maxrss is in KB on Linux; the fork inherits the parent's pages,
+        # so report the growth over the starting RSS.
+        'peak_rss_mb': round(max(end_self.ru_maxrss - start_rss, 0) / 1024, 1),
+        'child_peak_rss_mb': round(end_children.ru_maxrss / 1024, 1),
+    })
+    conn.close()
+
+
+def measure(fn, *args, repeat=1):
+    ctx = multiprocessing.get_context('fork')
+    runs = []
+    for _ in range(repeat):
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_run_case, args=(child_conn, fn, args))
+        proc.start()
+        child_conn.close()
+        runs.append(parent_conn.recv())
+        proc.join()
+    return min(runs, key=lambda r: r['wall_s'])
+
+
+def print_rows(rows):
+    if not rows:
+        print('no results')
+        return
+    keys = list(dict.fromkeys(k for row in rows for k in row))
+    rows = [{k: row.get(k, '') for k in keys} for row in rows]
+    widths = [max(len(str(k)), *(len(str(r[k])) for r in rows)) for k in keys]
+    print('  '.join(str(k).ljust(w) for k, w in zip(keys, widths)))
+    for row in rows:
+        print('  '.join(str(row[k]).ljust(w) for k, w in zip(keys, widths)))
+
+
+# ═══════════════════════════════════════════════════════════════
+#  SYNTHETIC INPUTS
+# ═══════════════════════════════════════════════════════════════
+def make_image(path, megapixels):
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    Image.radial_gradient('L').resize((width, height)).convert('RGB').save(path, quality=90)
+    return width, height
+
+
+def make_transcript(chars, seed=0):
+    # Deterministic sentences, so split_transcript cuts the same chunks every run
+    rng = random.Random(seed)
+    words = ('video', 'hôm nay', 'chúng ta', 'sẽ', 'nói', 'về', 'cách', 'làm', 'sản phẩm',
+             'khách hàng', 'thị trường', 'quan trọng', 'bước', 'tiếp theo', 'kết quả', 'dữ liệu')
+    sentences = []
+    size = 0
+    while size < chars:
+        sentence = ' '.join(rng.choice(words) for _ in range(rng.randint(6, 20))).capitalize() + '.'
+        sentences.append(sentence)
+        size += len(sentence) + 1
+    return ' '.join(sentences)
+
+
+def make_video(path, width, height, seconds):
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc=size={width}x{height}:rate=30',
+        '-f', 'lavfi', '-i', 'sine=frequency=440',
+        '-t', str(seconds),
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', path
+    ], check=True)
+
+
+# ═══════════════════════════════════════════════════════════════
+#  WATERMARK: full-frame vs crop-sized overlay
+# ═══════════════════════════════════════════════════════════════
+def full_frame_watermark_image(input_path, output_path):
+    # The previous implementation: a transparent layer as large as the
+    # image, composited over a full RGBA copy.
+    with Image.open(input_path) as img:
+        img = img.convert('RGBA')
+        patch, position = app.get_watermark_overlay(img.width, img.height)
+        layer = Image.new('RGBA', img.size, (0, 0, 0, 0))
+        layer.paste(patch, position)
+        out = Image.alpha_composite(img, layer)
+        if output_path.lower().endswith(('.jpg', '.jpeg')):
+            out = out.convert('RGB')
+        out.save(output_path)
+
+
+def full_frame_watermark_video(input_path, output_path, width, height, workdir):
+    patch, position = app.get_watermark_overlay(width, height)
+    layer = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    layer.paste(patch, position)
+    layer_path = os.path.join(workdir, 'full_frame_wm.png')
+    layer.save(layer_path)
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y', '-i', input_path, '-i', layer_path,
+        '-filter_complex', 'overlay=0:0',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23', '-c:a', 'copy',
+        output_path
+    ], check=True)
+
+
+def crop_watermark_video(input_path, output_path, width, height):
+    wm_path, (x, y) = app.get_watermark_overlay_file(width, height)
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y', '-i', input_path, '-i', wm_path,
+        '-filter_complex', f'overlay={x}:{y}',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23', '-c:a', 'copy',
+        output_path
+    ], check=True)
+
+
+def bench_watermark(args, workdir):
+    rows = []
+    for megapixels in args.sizes:
+        src = os.path.join(workdir, f'src_{megapixels}mp.jpg')
+        width, height = make_image(src, megapixels)
+        for name, fn in (('full-frame', full_frame_watermark_image),
+                         ('crop', app.add_watermark_to_image)):
+            result = measure(fn, src, os.path.join(workdir, f'out_{name}.jpg'), repeat=args.repeat)
+            rows.append({'case': f'image {megapixels}MP {width}x{height}', 'path': name, **result})
+
+    if args.video:
+        if not shutil.which('ffmpeg'):
+            print('ffmpeg not found, skipping video cases', file=sys.stderr)
+        else:
+            for width, height in ((1920, 1080), (3840, 2160)):
+                src = os.path.join(workdir, f'src_{height}p.mp4')
+                make_video(src, width, height, args.seconds)
+                out = os.path.join(workdir, 'out.mp4')
+                for name, result in (
+                    ('full-frame', measure(full_frame_watermark_video, src, out, width, height,
+                                           workdir, repeat=args.repeat)),
+                    ('crop', measure(crop_watermark_video, src, out, width, height,
+                                     repeat=args.repeat)),
+                ):
+                    rows.append({'case': f'video {height}p {args.seconds}s', 'path': name, **result})
+    return rows
+
+
+# ═══════════════════════════════════════════════════════════════
+#  CONTACT SHEET: full decode vs seek/keyframe extraction
+# ═══════════════════════════════════════════════════════════════
+def bench_contactsheet(args, workdir):
+    if not shutil.which('ffmpeg'):
+        print('ffmpeg not found, skipping contact sheet cases', file=sys.stderr)
+        return []
+
+    rows = []
+    for width, height in ((1920, 1080), (3840, 2160)):
+        src = os.path.join(workdir, f'src_{height}p.mp4')
+        make_video(src, width, height, args.seconds)
+        for extract in app.CONTACT_SHEET_EXTRACT_MODES:
+            result = measure(app.create_contact_sheet, src, 3, 320, 5,
+                             os.path.join(workdir, f'sheet_{extract}.jpg'), None, extract,
+                             repeat=args.repeat)
+            rows.append({'case': f'video {height}p {args.seconds}s', 'path': extract, **result})
+    return rows
+
+
+# ═══════════════════════════════════════════════════════════════
+#  SUMMARIZER: map-reduce against a stub Gemini model
+# ═══════════════════════════════════════════════════════════════
+class StubModel:
+    # Stands in for genai.GenerativeModel: a fixed latency per request and a
+    # reply about a twentieth of the prompt, so reduce rounds shrink the way
+    # real summaries do
+    def __init__(self, latency):
+        self.latency = latency
+
+    def reply(self, prompt):
+        time.sleep(self.latency)
+        return prompt[-max(len(prompt) // 20, 200):]
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        text = self.reply(prompt)
+        if not stream:
+            return SimpleNamespace(text=text)
+        return (SimpleNamespace(text=text[i:i + 200]) for i in range(0, len(text), 200))
+
+
+def summarize_case(text, latency):
+    summary = app.summarize_text(text, None, model=StubModel(latency), on_partial=lambda _text: None)
+    if summary.startswith(app.SUMMARY_ERROR_PREFIX):
+        raise RuntimeError(summary)
+
+
+def bench_summarize(args, workdir):
+    rows = []
+    for chars in args.transcripts:
+        text = make_transcript(chars)
+        result = measure(summarize_case, text, args.stub_latency, repeat=args.repeat)
+        rows.append({'case': f'transcript {chars // 1000}k chars', 'path': 'summarize_text', **result})
+    return rows
+
+
+# ═══════════════════════════════════════════════════════════════
+#  SUITE: every pipeline as it ships, for regression tracking
+# ═══════════════════════════════════════════════════════════════
+def bench_suite(args, workdir):
+    rows = []
+    for megapixels in args.megapixels:
+        src = os.path.join(workdir, f'src_{megapixels}mp.jpg')
+        width, height = make_image(src, megapixels)
+        result = measure(app.add_watermark_to_image, src, os.path.join(workdir, 'out.jpg'),
+                         repeat=args.repeat)
+        rows.append({'case': f'image {megapixels}MP {width}x{height}', 'path': 'add_watermark_to_image',
+                     **result})
+
+    if not shutil.which('ffmpeg'):
+        print('ffmpeg not found, skipping video cases', file=sys.stderr)
+    else:
+        for height in args.resolutions:
+            width = height * 16 // 9
+            for seconds in args.durations:
+                src = os.path.join(workdir, f'src_{height}p_{seconds}s.mp4')
+                make_video(src, width, height, seconds)
+                case = f'video {height}p {seconds}s'
+                result = measure(app.add_watermark_to_video, src, os.path.join(workdir, 'out.mp4'),
+                                 repeat=args.repeat)
+                rows.append({'case': case, 'path': 'add_watermark_to_video', **result})
+                result = measure(app.create_contact_sheet, src, 3, 320, 5,
+                                 os.path.join(workdir, 'sheet.jpg'), repeat=args.repeat)
+                rows.append({'case': case, 'path': 'create_contact_sheet', **result})
+                os.remove(src)
+
+    return rows + bench_summarize(args, workdir)
+
+
+BENCHMARKS = {
+    'watermark': bench_watermark,
+    'contactsheet': bench_contactsheet,
+    'summarize': bench_summarize,
+    'suite': bench_suite,
+}
+
+
+# ═══════════════════════════════════════════════════════════════
+#  RESULTS: JSON files and baseline comparison
+# ═══════════════════════════════════════════════════════════════
+def environment():
+    try:
+        ffmpeg = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True).stdout.split('\n')[0]
+    except OSError:
+        ffmpeg = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'ffmpeg': ffmpeg,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def load_results(path):
+    # Accepts a file written by --output or a plain --json row list
+    with open(path) as f:
+        data = json.load(f)
+    return data['results'] if isinstance(data, dict) else data
+
+
+def compare_to_baseline(rows, baseline, threshold):
+    # Adds the relative change of wall and CPU time to each row; returns
+    # the rows that got slower by more than threshold on both
+    previous = {(row['case'], row['path']): row for row in baseline}
+    regressions = []
+    for row in rows:
+        before = previous.get((row['case'], row['path']))
+        if not before:
+            row['change'] = 'new'
+            continue
+        changes = {key: row[key] / before[key] - 1 for key in ('wall_s', 'cpu_s') if before.get(key)}
+        row['baseline_wall_s'] = before['wall_s']
+        row['change'] = ' '.join(f'{key[:-2]} {value:+.0%}' for key, value in changes.items())
+        if changes and min(changes.values()) > threshold:
+            row['change'] += ' REGRESSION'
+            regressions.append(row)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OTSU Toolkit benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--sizes', default='12,24,50',
+                        type=lambda v: [float(x) for x in v.split(',')],
+                        help='image sizes in megapixels')
+    parser.add_argument('--video', action='store_true', help='include ffmpeg video cases')
+    parser.add_argument('--seconds', type=int, default=5, help='synthetic video duration')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per case (best is kept)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--megapixels', default='1,5,12,24,50',
+                        type=lambda v: [float(x) for x in v.split(',')],
+                        help='suite: image sizes in megapixels')
+    parser.add_argument('--resolutions', default='720,1080,2160',
+                        type=lambda v: [int(x) for x in v.split(',')],
+                        help='suite: video heights (16:9 testsrc)')
+    parser.add_argument('--durations', default='5,30',
+                        type=lambda v: [int(x) for x in v.split(',')],
+                        help='suite: video durations in seconds')
+    parser.add_argument('--transcripts', default='20000,200000,1000000',
+                        type=lambda v: [int(x) for x in v.split(',')],
+                        help='summarize: transcript sizes in characters')
+    parser.add_argument('--stub-latency', type=float, default=0.05,
+                        help='summarize: seconds per stub Gemini request')
+    parser.add_argument('--output', help='write results and environment to this JSON file')
+    parser.add_argument('--baseline', help='compare against a JSON file written by --output')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown (wall and CPU) that counts as a regression')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='otsu_bench_')
+    try:
+        rows = BENCHMARKS[args.benchmark](args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'benchmark': args.benchmark, 'environment': environment(), 'results': rows},
+                      f, indent=2)
+
+    regressions = []
+    if args.baseline:
+        regressions = compare_to_baseline(rows, load_results(args.baseline), args.threshold)
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_rows(rows)
+
+    if regressions:
+        print(f'{len(regressions)} case(s) slower than the baseline by more than {args.threshold:.0%}',
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+# ═══════════════════════════════════════════
+# OTSU Toolkit — gunicorn settings
+# ═══════════════════════════════════════════
+# gunicorn --config gunicorn.conf.py app:app
+#
+# With GUNICORN_PRELOAD=1 (the default) app.py is imported and warmed up
+# once in the master, and every worker starts from that copy: no import or
+# font cost on the first request after a deploy or worker recycle.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 10000)}"
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 300))
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+
+def when_ready(server):
+    # Master, after the preload and before the first fork
+    if preload_app:
+        import app
+        state = app.warm_up()
+        server.log.info('Warm-up %s in %ss', state['state'], state.get('seconds'))
+
+
+def pre_fork(server, worker):
+    if preload_app:
+        import app
+        app.close_db()
+
+
+def post_worker_init(worker):
+    # Without preload every worker imports the app (and warms up) on its own.
+    # The disk sweeper's first pass runs as the worker starts.
+    import app
+    app.warm_up()
+    app.start_disk_manager()
@@ -71,6 +71,7 @@ document.addEventListener('DOMContentLoaded', () => {
         progressBarId: 'watermark-progress-bar',
         resultAreaId: 'watermark-result',
         uploadEndpoint: '/api/watermark/upload',
+        tool: 'watermark',
         onResult: (result) => {
             const previewEl = document.getElementById('watermark-result-preview');
             const downloadBtn = document.getElementById('watermark-download-btn');
@@ -78,7 +79,8 @@ document.addEventListener('DOMContentLoaded', () => {
             if (result.type === 'image') {
                 previewEl.innerHTML = `<img src="/preview/${result.filename}" alt="Watermarked">`;
             } else {
-                previewEl.innerHTML = `<video src="/preview/${result.filename}" controls></video>`;
+                const videoFile = result.preview_filename || result.filename;
+                previewEl.innerHTML = `<video src="/preview/${videoFile}" controls></video>`;
             }
 
             // Build proper download filename: originalname_watermarked.ext
@@ -108,32 +110,50 @@ document.addEventListener('DOMContentLoaded', () => {
         progressBarId: 'contactsheet-progress-bar',
         resultAreaId: 'contactsheet-result',
         uploadEndpoint: '/api/contactsheet/upload',
+        tool: 'contactsheet',
         getExtraFormData: () => {
             return {
+                mode: document.getElementById('cs-mode').value,
                 interval: document.getElementById('cs-interval').value,
                 width: document.getElementById('cs-width').value,
-                cols: document.getElementById('cs-cols').value
+                cols: document.getElementById('cs-cols').value,
+                target_tiles: document.getElementById('cs-target-tiles').value,
+                output_format: document.getElementById('cs-output-format').value
             };
         },
+        onPartialResult: (partial) => {
+            if (partial.pages && partial.pages.length) {
+                renderContactSheetPages(partial.pages);
+                document.getElementById('contactsheet-result').classList.remove('hidden');
+            }
+        },
         onResult: (result) => {
-            const previewEl = document.getElementById('contactsheet-result-preview');
             const downloadBtn = document.getElementById('contactsheet-download-btn');
             const metaEl = document.getElementById('contactsheet-meta');
 
-            // Build proper download filename: originalname_contact_sheet.jpg
+            // Build proper download filename: originalname_contact_sheet.jpg (.zip/.pdf for several pages)
             const origName = result.original_name || 'video';
             const lastDot = origName.lastIndexOf('.');
             const baseName = lastDot > 0 ? origName.substring(0, lastDot) : origName;
-            const downloadName = `${baseName}_contact_sheet.jpg`;
+            const extension = result.filename.substring(result.filename.lastIndexOf('.'));
+            const downloadName = `${baseName}_contact_sheet${extension}`;
 
-            previewEl.innerHTML = `<img src="/preview/${result.filename}" alt="Contact Sheet">`;
+            renderContactSheetPages(result.pages || [result.filename]);
             downloadBtn.href = `/download/${result.filename}?original_name=${encodeURIComponent(downloadName)}`;
             downloadBtn.setAttribute('download', downloadName);
 
-            metaEl.innerHTML = `${result.duration}s • ${result.frames} frames • Grid ${result.grid}`;
+            const pages = result.pages && result.pages.length > 1 ? ` • ${result.pages.length} trang` : '';
+            metaEl.innerHTML = `${result.duration}s • ${result.frames} frames • Grid ${result.grid}${pages}`;
         }
     });
 
+    function renderContactSheetPages(pages) {
+        const previewEl = document.getElementById('contactsheet-result-preview');
+        previewEl.innerHTML = pages
+            .map((page, i) => `<img src="/preview/${page}" alt="Contact Sheet ${i + 1}" loading="lazy">`)
+            .join('');
+    }
+
     // ═══ YOUTUBE MODULE ═══
     const ytSubmitBtn = document.getElementById('youtube-submit-btn');
     const ytProgressArea = document.getElementById('youtube-progress');
@@ -180,8 +200,15 @@ document.addEventListener('DOMContentLoaded', () => {
 
             // Poll for status
             pollTaskStatus(data.task_id, {
-                onProgress: (progress) => {
+                onProgress: (progress, detail, partial) => {
                     ytProgressText.textContent = progress || 'Đang xử lý...';
+                    // Streamed summary text, rendered while Gemini is still writing
+                    if (partial && partial.summary) {
+                        ytResultArea.classList.remove('hidden');
+                        document.getElementById('yt-result-title').textContent = partial.title || 'Video';
+                        document.getElementById('yt-result-summary').textContent = partial.summary;
+                        document.getElementById('yt-result-transcript').textContent = '';
+                    }
                 },
                 onComplete: (result) => {
                     ytProgressArea.classList.add('hidden');
@@ -242,6 +269,8 @@ document.addEventListener('DOMContentLoaded', () => {
         const submitBtn = document.getElementById(config.submitBtnId);
         const progressArea = document.getElementById(config.progressAreaId);
         const progressText = document.getElementById(config.progressTextId);
+        const progressBar = document.getElementById(config.progressBarId);
+        const indeterminate = progressBar.classList.contains('indeterminate');
         const resultArea = document.getElementById(config.resultAreaId);
 
         let selectedFile = null;
@@ -318,25 +347,31 @@ document.addEventListener('DOMContentLoaded', () => {
             resultArea.classList.add('hidden');
             progressArea.classList.remove('hidden');
             progressText.textContent = 'Đang tải file lên...';
-
-            const formData = new FormData();
-            formData.append('file', selectedFile);
+            progressBar.classList.toggle('indeterminate', indeterminate);
+            progressBar.style.width = '';
 
             // Extra form data (for contact sheet)
-            if (config.getExtraFormData) {
-                const extra = config.getExtraFormData();
-                for (const [key, value] of Object.entries(extra)) {
-                    formData.append(key, value);
-                }
-            }
+            const extra = config.getExtraFormData ? config.getExtraFormData() : {};
 
             try {
-                const response = await fetch(config.uploadEndpoint, {
-                    method: 'POST',
-                    body: formData
-                });
+                let data;
+                if (selectedFile.size > CHUNKED_UPLOAD_THRESHOLD) {
+                    data = await chunkedUpload(selectedFile, config.tool, extra, (percent) => {
+                        progressText.textContent = `Đang tải file lên... ${percent}%`;
+                    });
+                } else {
+                    const formData = new FormData();
+                    formData.append('file', selectedFile);
+                    for (const [key, value] of Object.entries(extra)) {
+                        formData.append(key, value);
+                    }
 
-                const data = await response.json();
+                    const response = await fetch(config.uploadEndpoint, {
+                        method: 'POST',
+                        body: formData
+                    });
+                    data = await response.json();
+                }
 
                 if (!data.success) {
                     throw new Error(data.error || 'Upload failed');
@@ -345,8 +380,16 @@ document.addEventListener('DOMContentLoaded', () => {
                 progressText.textContent = 'Đang xử lý...';
 
                 pollTaskStatus(data.task_id, {
-                    onProgress: (progress) => {
+                    onProgress: (progress, detail, partial) => {
                         progressText.textContent = progress || 'Đang xử lý...';
+                        if (detail && detail.percent != null) {
+                            progressBar.classList.remove('indeterminate');
+                            progressBar.style.width = `${detail.percent}%`;
+                        }
+                        // Results that arrive in pieces (e.g. contact sheet pages)
+                        if (partial && config.onPartialResult) {
+                            config.onPartialResult(partial);
+                        }
                     },
                     onComplete: (result) => {
                         progressArea.classList.add('hidden');
@@ -380,27 +423,144 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    // ═══ Task Polling ═══
+    // ═══ Chunked Upload ═══
+    // Large files go up in checksummed chunks; after a failed chunk the
+    // server's offset tells us where to resume instead of starting over.
+    const CHUNKED_UPLOAD_THRESHOLD = 16 * 1024 * 1024;
+    const CHUNK_MAX_RETRIES = 5;
+
+    async function sha256Hex(blob) {
+        if (!window.crypto || !crypto.subtle) {
+            return null;
+        }
+        const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+        return Array.from(new Uint8Array(digest))
+            .map(b => b.toString(16).padStart(2, '0'))
+            .join('');
+    }
+
+    async function chunkedUpload(file, tool, options, onProgress) {
+        const initResponse = await fetch('/api/upload/init', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size })
+        });
+        const init = await initResponse.json();
+        if (!init.success) {
+            throw new Error(init.error || 'Upload failed');
+        }
+
+        const uploadUrl = `/api/upload/${init.upload_id}`;
+        let offset = 0;
+        let failures = 0;
+
+        while (offset < file.size) {
+            const chunk = file.slice(offset, offset + init.chunk_size);
+            try {
+                const headers = { 'Upload-Offset': String(offset) };
+                const checksum = await sha256Hex(chunk);
+                if (checksum) {
+                    headers['X-Chunk-SHA256'] = checksum;
+                }
+
+                const response = await fetch(uploadUrl, { method: 'PUT', headers, body: chunk });
+                const result = await response.json();
+                if (!response.ok) {
+                    throw Object.assign(new Error(result.error || 'Upload failed'), { offset: result.offset });
+                }
+                offset = result.offset;
+                failures = 0;
+            } catch (error) {
+                if (++failures > CHUNK_MAX_RETRIES) {
+                    throw error;
+                }
+                await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+
+                if (error.offset !== undefined) {
+                    offset = error.offset;
+                } else {
+                    // Connection dropped: ask how much actually arrived
+                    const status = await fetch(uploadUrl).then(r => r.json()).catch(() => null);
+                    if (status && status.offset !== undefined) {
+                        offset = status.offset;
+                    }
+                }
+            }
+            onProgress(Math.round(offset / file.size * 100));
+        }
+
+        const completeResponse = await fetch(`${uploadUrl}/complete`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ tool, options })
+        });
+        return completeResponse.json();
+    }
+
+    // ═══ Task Status ═══
+    // Returns true once the task reached a final state.
+    function handleTaskStatus(data, callbacks) {
+        if (data.status === 'processing' || data.status === 'queued') {
+            if (callbacks.onProgress) {
+                callbacks.onProgress(data.progress, data.progress_detail, data.result);
+            }
+        } else if (data.status === 'completed') {
+            if (callbacks.onComplete) {
+                callbacks.onComplete(data.result);
+            }
+            return true;
+        } else if (data.status === 'failed' || data.error) {
+            if (callbacks.onError) {
+                callbacks.onError(data.error || 'Unknown error');
+            }
+            return true;
+        }
+        return false;
+    }
+
+    // Server-sent events stream, falling back to polling when the browser
+    // or server can't stream.
     function pollTaskStatus(taskId, callbacks) {
+        if (!window.EventSource) {
+            pollTaskStatusInterval(taskId, callbacks);
+            return;
+        }
+
+        let finished = false;
+        const source = new EventSource(`/api/status/${taskId}/stream`);
+
+        source.onmessage = (event) => {
+            if (handleTaskStatus(JSON.parse(event.data), callbacks)) {
+                finished = true;
+                source.close();
+            }
+        };
+
+        source.addEventListener('gone', () => {
+            finished = true;
+            source.close();
+            if (callbacks.onError) {
+                callbacks.onError('Task not found');
+            }
+        });
+
+        source.onerror = () => {
+            // CONNECTING means the browser is already reconnecting by itself
+            if (!finished && source.readyState === EventSource.CLOSED) {
+                finished = true;
+                pollTaskStatusInterval(taskId, callbacks);
+            }
+        };
+    }
+
+    function pollTaskStatusInterval(taskId, callbacks) {
         const interval = setInterval(async () => {
             try {
                 const response = await fetch(`/api/status/${taskId}`);
                 const data = await response.json();
 
-                if (data.status === 'processing' || data.status === 'queued') {
-                    if (callbacks.onProgress) {
-                        callbacks.onProgress(data.progress);
-                    }
-                } else if (data.status === 'completed') {
+                if (handleTaskStatus(data, callbacks)) {
                     clearInterval(interval);
-                    if (callbacks.onComplete) {
-                        callbacks.onComplete(data.result);
-                    }
-                } else if (data.status === 'failed') {
-                    clearInterval(interval);
-                    if (callbacks.onError) {
-                        callbacks.onError(data.error || 'Unknown error');
-                    }
                 }
             } catch (error) {
                 clearInterval(interval);
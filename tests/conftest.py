@@ -0,0 +1,43 @@
+import atexit
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its settings at import time: point the database at a
+# throwaway file before the first import
+_DB_DIR = tempfile.mkdtemp(prefix='otsu_tests_')
+atexit.register(shutil.rmtree, _DB_DIR, ignore_errors=True)
+os.environ['TOOLKIT_DB_PATH'] = os.path.join(_DB_DIR, 'toolkit.db')
+os.environ.setdefault('WARMUP', '0')
+os.environ['DISK_SWEEP_INTERVAL'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as toolkit  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # Task outputs go to a per-test folder instead of the repo's output/
+    output = tmp_path / 'output'
+    output.mkdir()
+    monkeypatch.setattr(toolkit, 'OUTPUT_FOLDER', str(output))
+    return toolkit
+
+
+requires_ffmpeg = pytest.mark.skipif(not (shutil.which('ffmpeg') and shutil.which('ffprobe')),
+                                     reason='ffmpeg/ffprobe not installed')
+
+
+def make_video(path, source, seconds):
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f'{source}:size=320x180:rate=25',
+        '-t', str(seconds),
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+        str(path)
+    ], check=True)
+    return str(path)
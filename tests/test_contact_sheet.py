@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from conftest import make_video, requires_ffmpeg
+
+pytestmark = requires_ffmpeg
+
+
+@pytest.fixture
+def static_video(tmp_path):
+    return make_video(tmp_path / 'static.mp4', 'color=c=gray', 4)
+
+
+def run_task(app, video, **options):
+    options = {'interval': 1, 'width': 160, 'cols': 5, 'extract': 'seek', 'mode': 'interval',
+               'output_format': 'zip', **options}
+    app.process_contact_sheet_task('task', video, 'static.mp4', options)
+    return app.get_task('task')
+
+
+def test_static_video_in_scene_mode_has_one_frame(app, static_video):
+    task = run_task(app, static_video, mode='scene')
+    assert task['status'] == 'completed', task['error']
+    assert task['result']['mode'] == 'scene'
+    assert task['result']['frames'] == 1
+    assert os.path.exists(os.path.join(app.OUTPUT_FOLDER, task['result']['filename']))
+
+
+def test_scene_mode_without_scenes_falls_back_to_interval(app, static_video, monkeypatch):
+    monkeypatch.setattr(app, 'detect_scenes', lambda *args, **kwargs: [])
+    task = run_task(app, static_video, mode='scene')
+    assert task['status'] == 'completed', task['error']
+    assert task['result']['mode'] == 'interval'
+    assert task['result']['frames'] == 4
+    assert task['result']['grid'] == '5x1'
+
+
+def test_empty_timestamps_raise_a_clear_error(app, static_video, tmp_path):
+    with pytest.raises(ValueError, match='No frames'):
+        app.create_contact_sheet(static_video, output_path=str(tmp_path / 'sheet.jpg'), timestamps=[])
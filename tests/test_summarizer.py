@@ -0,0 +1,128 @@
+import threading
+
+import pytest
+
+from benchmark import StubModel, make_transcript
+
+
+class RecordingModel(StubModel):
+    def __init__(self, latency=0):
+        super().__init__(latency)
+        self.prompts = []
+        self.lock = threading.Lock()
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        with self.lock:
+            self.prompts.append(prompt)
+        return super().generate_content(prompt, stream, **kwargs)
+
+
+class TransientError(Exception):
+    code = 429
+
+
+class FlakyModel(RecordingModel):
+    # Fails the first `failures` requests with a rate-limit error
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self.attempts = 0
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        with self.lock:
+            self.attempts += 1
+            fail = self.attempts <= self.failures
+        if fail:
+            raise TransientError('429 Resource has been exhausted')
+        return super().generate_content(prompt, stream, **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(app, monkeypatch):
+    monkeypatch.setattr(app, 'SUMMARY_RETRY_BASE', 0)
+
+
+def test_split_transcript_keeps_sentences_under_the_limit(app):
+    text = make_transcript(50000)
+    chunks = app.split_transcript(text, 500)
+    assert len(chunks) > 1
+    assert all(app.estimate_tokens(chunk) <= 500 for chunk in chunks)
+    assert all(chunk.endswith('.') for chunk in chunks)
+    assert ' '.join(chunks) == text
+
+
+def test_split_transcript_cuts_text_without_punctuation(app):
+    chunks = app.split_transcript('a' * 10000, 500)
+    assert ''.join(chunks) == 'a' * 10000
+    assert all(app.estimate_tokens(chunk) <= 500 for chunk in chunks)
+
+
+def test_short_transcript_is_one_request(app):
+    model = RecordingModel()
+    app.summarize_text(make_transcript(2000), None, model=model)
+    assert len(model.prompts) == 1
+
+
+def test_long_transcript_is_mapped_then_reduced(app, monkeypatch):
+    monkeypatch.setattr(app, 'SUMMARY_CHUNK_TOKENS', 500)
+    text = make_transcript(200000)
+    chunks = app.split_transcript(text, 500)
+    model = RecordingModel()
+    progress = []
+
+    summary = app.summarize_text(text, None, model=model,
+                                 on_progress=lambda done, total: progress.append((done, total)))
+
+    assert not summary.startswith(app.SUMMARY_ERROR_PREFIX)
+    map_prompts = [p for p in model.prompts if p.startswith(app.MAP_SUMMARY_PROMPT.split('{')[0])]
+    reduce_prompts = [p for p in model.prompts if p.startswith(app.REDUCE_SUMMARY_PROMPT)]
+    assert len(map_prompts) == len(chunks)
+    assert reduce_prompts
+    # map + reduce rounds + the final request
+    assert len(model.prompts) == len(map_prompts) + len(reduce_prompts) + 1
+    assert progress[-1][0] == progress[-1][1] == len(model.prompts)
+
+
+def test_transient_errors_are_retried(app):
+    model = FlakyModel(failures=2)
+    summary = app.summarize_text(make_transcript(2000), None, model=model)
+    assert not summary.startswith(app.SUMMARY_ERROR_PREFIX)
+    assert model.attempts == 3
+    assert len(model.prompts) == 1
+
+
+def test_permanent_errors_are_reported(app):
+    class BrokenModel(StubModel):
+        def generate_content(self, prompt, stream=False, **kwargs):
+            raise ValueError('API key not valid')
+
+    summary = app.summarize_text(make_transcript(2000), None, model=BrokenModel(0))
+    assert summary == f'{app.SUMMARY_ERROR_PREFIX}API key not valid'
+
+
+def test_final_summary_is_streamed(app, monkeypatch):
+    monkeypatch.setattr(app, 'SUMMARY_CHUNK_TOKENS', 2000)
+    partials = []
+    summary = app.summarize_text(make_transcript(100000), None, model=RecordingModel(),
+                                 on_partial=partials.append)
+    assert len(partials) > 1
+    assert all(b.startswith(a) for a, b in zip(partials, partials[1:]))
+    assert partials[-1] == summary
+
+
+def test_blocked_stream_is_an_error(app, monkeypatch):
+    class BlockedChunk:
+        @property
+        def text(self):
+            raise ValueError('The response was blocked')
+
+    class BlockedModel(StubModel):
+        def generate_content(self, prompt, stream=False, **kwargs):
+            if not stream:
+                return super().generate_content(prompt, stream, **kwargs)
+            return iter([BlockedChunk()])
+
+    monkeypatch.setattr(app, 'SUMMARY_CHUNK_TOKENS', 2000)
+    summary = app.summarize_text(make_transcript(100000), None, model=BlockedModel(0),
+                                 on_partial=lambda _text: None)
+    assert summary.startswith(app.SUMMARY_ERROR_PREFIX)